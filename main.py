@@ -2,7 +2,7 @@ import streamlit as st
 import io
 from contextlib import redirect_stdout
 import os
-from scripts import script0, script1, script2, script2_1, script3, script3_1, script3_2, script3_3, script3_4, script4, script4_1, script4_2, script5, script5_1, script5_2
+from scripts import script0, script1, script2, script2_1, script3, script3_1, script3_2, script3_3, script3_4, script4, script4_1, script4_2, script5, script5_1, script5_2, parquet_mirror
 from scripts.script1 import DESTINATION_FOLDER as persistent_folder
 from streamlit_extras.bottom_container import bottom
 from PIL import Image
@@ -94,6 +94,10 @@ with st.sidebar:
         fig, output = capture_output(script3_4.run) 
         st.write(fig) 
 
+    if st.button("3 to 3.4 - Load Trusted zone with all its stages"):
+        fig, output = capture_output(script3.run_all) 
+        st.write(fig) 
+
     if st.button("4 - Load exploitation zone"):
         fig, output = capture_output(script4.run) 
         st.write(fig) 
@@ -118,6 +122,10 @@ with st.sidebar:
         fig, output = capture_output(script5_2.run) 
         st.write(fig)   
 
+    if st.button("6 - Export zones to Parquet mirror"):
+        fig, output = capture_output(parquet_mirror.run) 
+        st.write(fig)   
+
 
 if view_type == "Text View":
     # Show directory structure as text
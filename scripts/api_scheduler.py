@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+
+QUOTA_STATE_PATH = "./.idealista_quota.json"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_second=1, monthly_quota=100, max_retries=5, backoff=1.0, state_path=QUOTA_STATE_PATH):
+        self.interval = 1 / requests_per_second
+        self.monthly_quota = monthly_quota
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.state_path = state_path
+
+        # Counters exposed to the caller
+        self.issued = 0
+        self.throttled = 0
+        self.retried = 0
+
+        self._next_slot = 0.0
+        self._month, self._monthly_used = self.load_monthly_usage()
+
+    def load_monthly_usage(self):
+        current_month = datetime.now().strftime("%Y_%m")
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            # The quota resets every month
+            if state.get("month") == current_month:
+                return current_month, state.get("used", 0)
+        return current_month, 0
+
+    def save_monthly_usage(self):
+        with open(self.state_path, "w") as state_file:
+            json.dump({"month": self._month, "used": self._monthly_used}, state_file)
+
+    async def acquire(self):
+        # No await happens before the slot is booked, so concurrent pages can not race here
+        if self._monthly_used >= self.monthly_quota:
+            raise QuotaExceeded(f"Monthly quota of {self.monthly_quota} requests reached")
+        self._monthly_used += 1
+        self.save_monthly_usage()
+
+        # Book the next free slot, requests are spaced by the per-second quota
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+
+        if slot > now:
+            self.throttled += 1
+            await asyncio.sleep(slot - now)
+        self.issued += 1
+
+    async def send(self, make_request):
+        # make_request returns a new aiohttp request context on every call
+        for attempt in range(self.max_retries + 1):
+            await self.acquire()
+            async with make_request() as response:
+                if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                    # Honour Retry-After when the API sends it, back off exponentially otherwise
+                    retry_after = response.headers.get("Retry-After")
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt
+                else:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)   # Idealista does not always send a json content type
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def remaining(self):
+        # Requests left in the monthly quota
+        return max(self.monthly_quota - self._monthly_used, 0)
+
+    def counters(self):
+        return {"issued": self.issued, "throttled": self.throttled, "retried": self.retried}
@@ -0,0 +1,39 @@
+import pyarrow as pa
+
+BATCH_SIZE = 100000
+
+
+def run_in_batches(con, source_table, destination_table, transform, batch_size=BATCH_SIZE):
+    # The source is read through its own cursor, so writing the batches does not interrupt the stream
+    reader_con = con.cursor()
+    reader = reader_con.execute(f"SELECT * FROM {source_table}").fetch_record_batch(batch_size)
+
+    # Batches go to a staging table that replaces the destination once every batch is written,
+    # this also allows the source and the destination to be the same table
+    staging_table = f"{destination_table}__batches"
+    con.execute(f"DROP TABLE IF EXISTS {staging_table}")
+
+    rows = 0
+    created = False
+    for batch in reader:
+        transformed = pa.Table.from_pandas(transform(batch.to_pandas()), preserve_index=False)
+
+        # Arrow tables are scanned by DuckDB without copying them
+        con.register('transformed_batch', transformed)
+        if not created:
+            con.execute(f"CREATE TABLE {staging_table} AS SELECT * FROM transformed_batch")
+            created = True
+        else:
+            con.execute(f"INSERT INTO {staging_table} BY NAME SELECT * FROM transformed_batch")
+        con.unregister('transformed_batch')
+        rows += transformed.num_rows
+    reader_con.close()
+
+    if not created:
+        print(f"Table '{source_table}' is empty, '{destination_table}' was not replaced.")
+        con.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        return 0
+
+    con.execute(f"DROP TABLE IF EXISTS {destination_table}")
+    con.execute(f"ALTER TABLE {staging_table} RENAME TO {destination_table}")
+    return rows
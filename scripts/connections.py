@@ -0,0 +1,57 @@
+import atexit
+import duckdb
+import os
+import threading
+
+# DuckDB resources for every database opened through this module, unset values keep the DuckDB defaults
+THREADS = os.environ.get('DUCKDB_THREADS')
+MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT')
+
+# One cached connection per database file: path -> (connection, read_only)
+_connections = {}
+_lock = threading.Lock()
+
+
+def get_config():
+    config = {}
+    if THREADS:
+        config['threads'] = int(THREADS)
+    if MEMORY_LIMIT:
+        config['memory_limit'] = MEMORY_LIMIT
+    return config
+
+
+def get_connection(db_path, read_only=False):
+    # Returns a cursor on the cached connection: it has its own transactions and can be used from
+    # another thread, closing it leaves the database open for the next caller
+    path = os.path.abspath(db_path)
+    with _lock:
+        connection, cached_read_only = _connections.get(path, (None, None))
+
+        # DuckDB opens a file once per process, a read-write connection also serves readers
+        if connection is not None and cached_read_only and not read_only:
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = duckdb.connect(path, read_only=read_only, config=get_config())
+            _connections[path] = (connection, read_only)
+        return connection.cursor()
+
+
+def close_connection(db_path):
+    # Needed before the file is replaced, moved or removed
+    path = os.path.abspath(db_path)
+    with _lock:
+        connection, _ = _connections.pop(path, (None, None))
+        if connection is not None:
+            connection.close()
+
+
+def close_all():
+    with _lock:
+        for connection, _ in _connections.values():
+            connection.close()
+        _connections.clear()
+
+
+atexit.register(close_all)
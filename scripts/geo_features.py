@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+# Points of interest with a name, a category and their coordinates (approximate for metro stations and beaches)
+POINTS_OF_INTEREST_CSV = './Archive/points_of_interest.csv'
+
+EARTH_RADIUS_KM = 6371
+
+# Number of points of interest of a category within these radii (km) of every house
+NEARBY_RADII_KM = {'metro': 0.5, 'beach': 1.0}
+
+# Houses processed at once, the distance matrix of a chunk has CHUNK_SIZE x points of interest values
+CHUNK_SIZE = 100000
+
+
+def load_points_of_interest(path=POINTS_OF_INTEREST_CSV):
+    return pd.read_csv(path)
+
+
+def haversine_matrix(latitudes, longitudes, poi_latitudes, poi_longitudes):
+    # Distances (km) between every house and every point of interest by broadcasting, shape (houses, points)
+    lat1, lon1 = np.radians(latitudes)[:, None], np.radians(longitudes)[:, None]
+    lat2, lon2 = np.radians(poi_latitudes)[None, :], np.radians(poi_longitudes)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def get_feature_columns(pois, radii=NEARBY_RADII_KM):
+    # Column name and type of every feature, in the order compute_geo_features returns them
+    columns = [(f"distance_to_{category}", 'DOUBLE') for category in pois['category'].unique()]
+    columns += [(f"{category}_within_{int(radius * 1000)}m", 'INT') for category, radius in radii.items() if category in set(pois['category'])]
+    return columns
+
+
+def compute_geo_features(points, pois=None, radii=NEARBY_RADII_KM, chunk_size=CHUNK_SIZE):
+    # points is a DataFrame with latitude and longitude, one row of features is returned per point
+    pois = load_points_of_interest() if pois is None else pois
+    features = points[['latitude', 'longitude']].reset_index(drop=True)
+
+    # No points, e.g. an empty exploitation zone: the ball tree can not be queried, the feature columns stay empty
+    if features.empty:
+        for name, data_type in get_feature_columns(pois, radii):
+            features[name] = pd.Series(dtype=float if data_type == 'DOUBLE' else int)
+        return features
+
+    latitudes = features['latitude'].to_numpy(dtype=float)
+    longitudes = features['longitude'].to_numpy(dtype=float)
+
+    # Distance to the closest point of interest of each category
+    categories = pois['category'].unique()
+    distances = {category: np.empty(len(features)) for category in categories}
+    for start in range(0, len(features), chunk_size):
+        end = start + chunk_size
+        matrix = haversine_matrix(latitudes[start:end], longitudes[start:end], pois['latitude'].to_numpy(), pois['longitude'].to_numpy())
+        for category in categories:
+            distances[category][start:end] = matrix[:, (pois['category'] == category).to_numpy()].min(axis=1)
+    for category in categories:
+        features[f"distance_to_{category}"] = distances[category]
+
+    # Counts of nearby points of interest from a ball tree on the sphere, haversine works on radians
+    houses = np.radians(np.column_stack([latitudes, longitudes]))
+    for category, radius in radii.items():
+        category_pois = pois[pois['category'] == category]
+        if category_pois.empty:
+            continue
+        tree = BallTree(np.radians(category_pois[['latitude', 'longitude']].to_numpy()), metric='haversine')
+        features[f"{category}_within_{int(radius * 1000)}m"] = tree.query_radius(houses, r=radius / EARTH_RADIUS_KM, count_only=True)
+
+    return features
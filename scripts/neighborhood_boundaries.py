@@ -0,0 +1,77 @@
+import duckdb
+import os
+
+from scripts.neighborhood_index import NeighborhoodIndex
+
+# Neighborhood polygons of Barcelona in WGS84 (e.g. the Open Data BCN 'BarcelonaCiutat_Barris' GeoJSON),
+# not shipped with the repository. Any format read by ST_Read works.
+NEIGHBORHOOD_BOUNDARIES = './Archive/barcelona_neighborhoods.geojson'
+# Property of the boundary file holding the neighborhood name
+BOUNDARY_NAME_COLUMN = 'nom_barri'
+
+
+def load_spatial(conn):
+    try:
+        conn.execute("INSTALL spatial; LOAD spatial;")
+        return True
+    except duckdb.Error as e:
+        print(f"Spatial extension not available: {e}")
+        return False
+
+
+def load_boundaries(conn, path=NEIGHBORHOOD_BOUNDARIES, name_column=BOUNDARY_NAME_COLUMN, index=None):
+    # The polygons are read once, later runs use the stored table
+    if conn.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'main' AND table_name = 'neighborhood_boundaries'").fetchone()[0]:
+        return True
+    if not os.path.exists(path):
+        print(f"Boundary file not found: {path}")
+        return False
+
+    conn.execute(f"""
+    CREATE TABLE neighborhood_boundaries AS
+    SELECT "{name_column}" AS name, CAST(NULL AS VARCHAR) AS neighborhood_id, geom
+    FROM ST_Read('{path}');
+    """)
+
+    # Polygons get the canonical id of their name, the same ids the income table is mapped to
+    index = index or NeighborhoodIndex.from_csv()
+    for (name,) in conn.execute("SELECT DISTINCT name FROM neighborhood_boundaries WHERE name IS NOT NULL").fetchall():
+        neighborhood, score = index.resolve(name)
+        if neighborhood is not None:
+            conn.execute("UPDATE neighborhood_boundaries SET neighborhood_id = ? WHERE name = ?", [neighborhood['neighborhood_id'], name])
+    return True
+
+
+def create_point_map(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS point_neighborhood (
+        latitude DOUBLE,
+        longitude DOUBLE,
+        neighborhood_id VARCHAR,
+        PRIMARY KEY (latitude, longitude)
+    );
+    """)
+
+
+def update_point_map(conn, points, path=NEIGHBORHOOD_BOUNDARIES):
+    # points is a DataFrame of distinct latitude/longitude pairs, only pairs missing from the map are assigned.
+    # Returns False when coordinates can not be used, the caller falls back to neighborhood names.
+    if not load_spatial(conn) or not load_boundaries(conn, path):
+        return False
+    create_point_map(conn)
+
+    conn.register('house_points', points)
+    # One vectorized join for all new points, DuckDB builds an R-tree over the polygons for it
+    conn.execute("""
+    INSERT INTO point_neighborhood
+    SELECT p.latitude, p.longitude, ANY_VALUE(b.neighborhood_id)
+    FROM (
+        SELECT DISTINCT latitude, longitude FROM house_points
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    ) p
+    ANTI JOIN point_neighborhood known ON known.latitude = p.latitude AND known.longitude = p.longitude
+    LEFT JOIN neighborhood_boundaries b ON ST_Intersects(b.geom, ST_Point(p.longitude, p.latitude))
+    GROUP BY p.latitude, p.longitude;
+    """)
+    conn.unregister('house_points')
+    return True
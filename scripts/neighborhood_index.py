@@ -0,0 +1,119 @@
+import csv
+import heapq
+import re
+import unicodedata
+from collections import defaultdict
+
+# Canonical neighborhoods of Barcelona with their reconciled names and Wikidata ids
+NEIGHBORHOODS_CSV = './Archive/income_opendatabcn_extended.csv'
+
+NGRAM_SIZE = 3
+# Matches below this Dice similarity are left unresolved
+MIN_SCORE = 0.5
+
+
+def normalize(name):
+    # Lowercase without accents or punctuation: 'Sant Gervasi - la Bonanova' -> 'sant gervasi la bonanova'
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', name).split())
+
+
+def get_features(normalized_name, n=NGRAM_SIZE):
+    # Character n-grams of the padded name plus its tokens
+    padded = f" {normalized_name} "
+    features = {padded[i:i + n] for i in range(len(padded) - n + 1)}
+    features.update(f"token:{token}" for token in normalized_name.split())
+    return features
+
+
+class NeighborhoodIndex:
+    def __init__(self, neighborhoods):
+        # neighborhoods are dicts with 'neighborhood_id', 'neighborhood', 'district' and a list of 'names'
+        self.neighborhoods = neighborhoods
+        self.exact = {}
+        self.names = []
+        self.postings = defaultdict(list)
+
+        for position, neighborhood in enumerate(neighborhoods):
+            for name in neighborhood['names']:
+                normalized_name = normalize(name)
+                if not normalized_name or normalized_name in self.exact:
+                    continue
+                self.exact[normalized_name] = position
+                features = get_features(normalized_name)
+                name_id = len(self.names)
+                self.names.append((position, len(features)))
+                for feature in features:
+                    self.postings[feature].append(name_id)
+
+    @classmethod
+    def from_csv(cls, path=NEIGHBORHOODS_CSV):
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        neighborhoods = [{
+            'neighborhood_id': row['neighborhood_id'],
+            'neighborhood': row['neighborhood'],
+            'district': row['district'],
+            'names': [row['neighborhood'], row['neighborhood_n'], row['neighborhood_n_reconciled']],
+        } for row in rows]
+        return cls(neighborhoods)
+
+    def search(self, name, k=3):
+        # Top k neighborhoods by Dice similarity of their features, only names sharing a feature are scored
+        normalized_name = normalize(name)
+        if normalized_name in self.exact:
+            return [(self.neighborhoods[self.exact[normalized_name]], 1.0)]
+
+        features = get_features(normalized_name)
+        shared = defaultdict(int)
+        for feature in features:
+            for name_id in self.postings.get(feature, ()):
+                shared[name_id] += 1
+
+        best = {}
+        for name_id, count in shared.items():
+            position, feature_count = self.names[name_id]
+            score = 2 * count / (len(features) + feature_count)
+            if score > best.get(position, 0):
+                best[position] = score
+        return [(self.neighborhoods[position], score) for position, score in heapq.nlargest(k, best.items(), key=lambda item: item[1])]
+
+    def resolve(self, name, min_score=MIN_SCORE):
+        matches = self.search(name, k=1)
+        if matches and matches[0][1] >= min_score:
+            return matches[0]
+        return None, 0.0
+
+
+def create_neighborhood_map(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS neighborhood_map (
+        name VARCHAR PRIMARY KEY,
+        neighborhood_id VARCHAR,
+        neighborhood VARCHAR,
+        district VARCHAR,
+        score DOUBLE
+    );
+    """)
+
+
+def update_neighborhood_map(conn, names, index=None):
+    # Only names missing from the map are resolved, known names are plain lookups
+    create_neighborhood_map(conn)
+    known = {row[0] for row in conn.execute("SELECT name FROM neighborhood_map").fetchall()}
+    missing = [name for name in set(names) if name is not None and name not in known]
+    if not missing:
+        return 0
+
+    index = index or NeighborhoodIndex.from_csv()
+    rows = []
+    for name in missing:
+        neighborhood, score = index.resolve(name)
+        # Unresolved names are stored too, so they are not searched again
+        if neighborhood is None:
+            rows.append((name, None, None, None, score))
+        else:
+            rows.append((name, neighborhood['neighborhood_id'], neighborhood['neighborhood'], neighborhood['district'], score))
+    conn.executemany("INSERT INTO neighborhood_map VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows)
@@ -0,0 +1,141 @@
+import duckdb
+import json
+import os
+
+from scripts.connections import get_config, get_connection
+
+ZONES = {
+    'formatted': './formatted_zone/formatted.db',
+    'trusted': './trusted_zone/trusted.db',
+    'exploitation': './exploitation_zone/exploitation.db',
+    'model': './model_zone/model.db',
+}
+MIRROR_FOLDER = './parquet_mirror'
+
+ROW_GROUP_SIZE = 122880
+# Tables are sorted by the first of these columns they have, so row group statistics allow pruning
+SORT_COLUMNS = ['timestamp', 'snapshot_date', 'neighborhood']
+
+# Fingerprints of the exported tables, kept hidden in the folder of each zone
+EXPORT_STATE_FILE = '.export_state.json'
+
+
+def get_fingerprint(con, table_name, columns, sort_columns, has_ledger):
+    # Cheap summary of a table, a table is exported again when it changes: its columns, row count and the range
+    # of its sort column, and for the formatted zone the content hashes of the landing files it was loaded from
+    fingerprint = [f"{name}:{data_type}" for name, data_type in columns]
+    bounds = f', CAST(MIN("{sort_columns[0]}") AS VARCHAR), CAST(MAX("{sort_columns[0]}") AS VARCHAR)' if sort_columns else ''
+    fingerprint += [str(value) for value in con.execute(f"SELECT COUNT(*){bounds} FROM {table_name}").fetchone()]
+    if has_ledger:
+        fingerprint += [content_hash for (content_hash,) in con.execute("SELECT content_hash FROM ingestion_ledger WHERE table_name = ? ORDER BY file_path", [table_name]).fetchall()]
+    return '|'.join(fingerprint)
+
+
+def load_export_state(output_dir):
+    state_path = os.path.join(output_dir, EXPORT_STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def save_export_state(output_dir, state):
+    # Replaced in one step like the parquet files
+    state_path = os.path.join(output_dir, EXPORT_STATE_FILE)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def export_zone(db_path, output_dir, force=False):
+    os.makedirs(output_dir, exist_ok=True)
+    state = {} if force else load_export_state(output_dir)
+
+    # Read only through the cached connection, the export does not block other readers of the zone
+    con = get_connection(db_path, read_only=True)
+    tables = [table[0] for table in con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main' AND table_type = 'BASE TABLE';").fetchall()]
+    has_ledger = 'ingestion_ledger' in tables
+
+    exported = 0
+    for table_name in tables:
+        columns = [column[:2] for column in con.execute(f"DESCRIBE {table_name}").fetchall()]
+        sort_columns = [column for column in SORT_COLUMNS if column in [name for name, _ in columns]][:1]
+        order_by = f'ORDER BY "{sort_columns[0]}"' if sort_columns else ''
+        parquet_file = os.path.join(output_dir, f"{table_name}.parquet")
+
+        fingerprint = get_fingerprint(con, table_name, columns, sort_columns, has_ledger and table_name != 'ingestion_ledger')
+        if state.get(table_name) == fingerprint and os.path.exists(parquet_file):
+            # Unchanged since the last export, the file is marked as current for the published zone
+            os.utime(parquet_file)
+            continue
+
+        # Written under a hidden name and renamed, readers never see a partial file
+        tmp_file = os.path.join(output_dir, f".{table_name}.parquet.tmp")
+        con.execute(f"""
+            COPY (SELECT * FROM {table_name} {order_by}) TO '{tmp_file}'
+            (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE {ROW_GROUP_SIZE});
+            """)
+        os.replace(tmp_file, parquet_file)
+        state[table_name] = fingerprint
+        save_export_state(output_dir, state)
+        exported += 1
+        print(f"Exported table {table_name} to {parquet_file}")
+
+    con.close()
+
+    # Tables dropped from the zone are dropped from the mirror too
+    for filename in os.listdir(output_dir):
+        if filename.endswith('.parquet') and filename[:-len('.parquet')] not in tables:
+            os.remove(os.path.join(output_dir, filename))
+    save_export_state(output_dir, {table_name: fingerprint for table_name, fingerprint in state.items() if table_name in tables})
+
+    print(f"Exported {exported} of {len(tables)} tables of {db_path}, the others did not change")
+    return exported
+
+
+def is_current(zone, table_name, zones=ZONES, mirror_folder=MIRROR_FOLDER):
+    # The mirror of a table is current when it was exported, or found unchanged, after the zone was last published
+    parquet_file = os.path.join(mirror_folder, zone, f"{table_name}.parquet")
+    return os.path.exists(parquet_file) and os.path.exists(zones[zone]) and os.path.getmtime(parquet_file) >= os.path.getmtime(zones[zone])
+
+
+def attach_mirror(con, zone, mirror_folder=MIRROR_FOLDER):
+    # One view per mirrored table, in a schema named after the zone (e.g. trusted.idealista)
+    zone_folder = os.path.join(mirror_folder, zone)
+    if not os.path.exists(zone_folder):
+        print(f"No parquet mirror found for zone '{zone}'")
+        return
+    con.execute(f"CREATE SCHEMA IF NOT EXISTS {zone};")
+    for filename in sorted(os.listdir(zone_folder)):
+        if filename.endswith('.parquet'):
+            table_name = filename[:-len('.parquet')]
+            parquet_file = os.path.join(zone_folder, filename)
+            con.execute(f"CREATE OR REPLACE VIEW {zone}.{table_name} AS SELECT * FROM read_parquet('{parquet_file}');")
+
+
+def connect_mirror(zones=ZONES, mirror_folder=MIRROR_FOLDER):
+    # In-memory database, any number of readers can query the mirror while the zones are being written.
+    # zones are the names of the zones to attach
+    con = duckdb.connect(config=get_config())
+    for zone in zones:
+        attach_mirror(con, zone, mirror_folder)
+    return con
+
+
+def export_all_zones(zones=ZONES, mirror_folder=MIRROR_FOLDER):
+    exported = {}
+    for zone, db_path in zones.items():
+        if not os.path.exists(db_path):
+            print(f"File not found: {db_path}")
+            continue
+        exported[zone] = export_zone(db_path, os.path.join(mirror_folder, zone))
+    return exported
+
+
+def run():
+    exported = export_all_zones()
+    return f"Exported zones to {MIRROR_FOLDER}: {exported}"
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,141 @@
+import duckdb
+import os
+from contextlib import contextmanager
+
+from scripts.script1 import copy_file, reflink_file, hardlink_file
+from scripts.connections import close_connection, get_config
+
+# Previous versions of each zone database kept next to it for rollback, 0 keeps none.
+# Only the first stage of a zone rotates them (script2, script3, script4, script5), the later stages of the same
+# pipeline run replace the live database in place, so every generation is a zone as a whole run left it
+KEEP_GENERATIONS = 3
+GENERATIONS_FOLDER = '.generations'
+
+# Staging copies of the stages running now, by database path. A stage run inside another stage of the
+# same zone (script3.run_all) writes to its copy, the zone is cloned and published once
+_active_stagings = {}
+
+
+def staging_path(db_path):
+    directory, filename = os.path.split(db_path)
+    return os.path.join(directory, f".{filename}.staging")
+
+
+def generation_path(db_path, generation):
+    directory, filename = os.path.split(db_path)
+    return os.path.join(directory, GENERATIONS_FOLDER, f"{filename}.{generation}")
+
+
+def clone_file(source_path, dest_path):
+    # Copy-on-write clone where the filesystem supports it, a plain copy otherwise
+    try:
+        reflink_file(source_path, dest_path)
+        return 'reflink'
+    except OSError:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        copy_file(source_path, dest_path)
+        return 'copy'
+
+
+def clone_database(source_path, dest_path):
+    # The WAL goes with its database, DuckDB replays it when the copy is opened
+    remove_database(dest_path)
+    mode = clone_file(source_path, dest_path)
+    if os.path.exists(source_path + '.wal'):
+        clone_file(source_path + '.wal', dest_path + '.wal')
+    return mode
+
+
+def move_database(source_path, dest_path):
+    os.replace(source_path, dest_path)
+    if os.path.exists(source_path + '.wal'):
+        os.replace(source_path + '.wal', dest_path + '.wal')
+    elif os.path.exists(dest_path + '.wal'):
+        os.remove(dest_path + '.wal')
+
+
+def remove_database(path):
+    for file in (path, path + '.wal'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def rotate_generations(db_path, keep=KEEP_GENERATIONS):
+    if keep < 1 or not os.path.exists(db_path):
+        return
+    os.makedirs(os.path.dirname(generation_path(db_path, 1)), exist_ok=True)
+
+    remove_database(generation_path(db_path, keep))
+    for generation in range(keep - 1, 0, -1):
+        if os.path.exists(generation_path(db_path, generation)):
+            move_database(generation_path(db_path, generation), generation_path(db_path, generation + 1))
+
+    # The live file stays in place until the new one replaces it, readers always find a database
+    first_generation = generation_path(db_path, 1)
+    try:
+        hardlink_file(db_path, first_generation)
+    except OSError:
+        clone_file(db_path, first_generation)
+    if os.path.exists(db_path + '.wal'):
+        os.replace(db_path + '.wal', first_generation + '.wal')
+
+
+def publish(staging, db_path, keep=KEEP_GENERATIONS, rotate=True):
+    # Cached connections to either file are closed, the next caller opens the published database
+    close_connection(staging)
+    close_connection(db_path)
+
+    # The WAL is merged first, the published database is a single file
+    con = duckdb.connect(staging, config=get_config())
+    con.execute("CHECKPOINT")
+    con.close()
+
+    if rotate:
+        rotate_generations(db_path, keep)
+    move_database(staging, db_path)
+
+
+@contextmanager
+def staged_database(db_path, keep=KEEP_GENERATIONS, rotate=True):
+    # The stage writes to a copy of the database, it is swapped in only when the stage succeeds.
+    # The copy is a reflink on btrfs and xfs, on other filesystems (ext4, overlayfs under Docker) it is a full
+    # copy of the zone, so stages that run one after the other should share one copy by nesting
+    path = os.path.abspath(db_path)
+    if path in _active_stagings:
+        # The outer stage publishes, or discards the copy when a stage fails
+        yield _active_stagings[path]
+        return
+
+    staging = staging_path(db_path)
+    close_connection(db_path)
+    if os.path.exists(db_path):
+        mode = clone_database(db_path, staging)
+        print(f"Staged {db_path} by {mode} ({os.path.getsize(staging) / 1024 ** 2:.1f} MB)")
+    else:
+        remove_database(staging)
+
+    _active_stagings[path] = staging
+    try:
+        yield staging
+    except BaseException:
+        close_connection(staging)
+        remove_database(staging)
+        raise
+    finally:
+        del _active_stagings[path]
+    publish(staging, db_path, keep, rotate)
+
+
+def list_generations(db_path, keep=KEEP_GENERATIONS):
+    return [generation for generation in range(1, keep + 1) if os.path.exists(generation_path(db_path, generation))]
+
+
+def rollback(db_path, generation=1, keep=KEEP_GENERATIONS):
+    # The chosen generation is published again, the current database becomes generation 1
+    source = generation_path(db_path, generation)
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"No generation {generation} of {db_path}")
+    staging = staging_path(db_path)
+    clone_database(source, staging)
+    publish(staging, db_path, keep)
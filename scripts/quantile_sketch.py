@@ -0,0 +1,209 @@
+import math
+
+# Log-bucket quantile sketches (DDSketch) kept as tables in the zone database.
+# A value x > 0 falls in bucket ceil(log_gamma(x)), every quantile read from the buckets is within
+# RELATIVE_ACCURACY of the exact one. Sketches of different snapshots or groups merge by summing counts.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+SKETCH_SCHEMA = 'sketch'
+
+# Groups with fewer values fall back to the sketch of the whole group, then to the whole table
+MIN_GROUP_COUNT = 20
+
+
+def bucket_expression(column):
+    return f"CAST(ceil(ln({column}) / {math.log(GAMMA)}) AS INTEGER)"
+
+
+def bucket_value(bucket):
+    # Value in the middle of the bucket, relative to its bounds
+    return f"2 * pow({GAMMA}, {bucket}) / ({GAMMA} + 1)"
+
+
+def create_sketch_tables(conn, table_name):
+    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {SKETCH_SCHEMA};")
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SKETCH_SCHEMA}.state (
+        table_name VARCHAR PRIMARY KEY,
+        watermark VARCHAR,
+        updated_at TIMESTAMP
+    );
+    """)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SKETCH_SCHEMA}.{table_name} (
+        group_key VARCHAR,
+        month DATE,
+        metric VARCHAR,
+        bucket INTEGER,
+        count BIGINT,
+        PRIMARY KEY (group_key, month, metric, bucket)
+    );
+    """)
+    # Counts added for the rows of the watermark time, taken out again when that time is counted again
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SKETCH_SCHEMA}.boundary (
+        table_name VARCHAR,
+        group_key VARCHAR,
+        month DATE,
+        metric VARCHAR,
+        bucket INTEGER,
+        count BIGINT
+    );
+    """)
+    # Months with rows appended before the watermark, they are counted again from scratch in the next update
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SKETCH_SCHEMA}.pending (
+        table_name VARCHAR,
+        month DATE
+    );
+    """)
+
+
+def month_expression(column):
+    return f"CAST(date_trunc('month', CAST({column} AS DATE)) AS DATE)"
+
+
+def reset_sketches(conn, table_name):
+    # Called when a table is rebuilt, the next update counts every row again
+    create_sketch_tables(conn, table_name)
+    for state_table in ('state', 'boundary', 'pending'):
+        conn.execute(f"DELETE FROM {SKETCH_SCHEMA}.{state_table} WHERE table_name = ?", [table_name])
+    conn.execute(f"DROP TABLE {SKETCH_SCHEMA}.{table_name}")
+
+
+def rewind_sketches(conn, table_name, rows_query, time_column):
+    # Called when rows are appended, the months of rows before the watermark (a late snapshot) are counted again
+    create_sketch_tables(conn, table_name)
+    state = conn.execute(f"SELECT watermark FROM {SKETCH_SCHEMA}.state WHERE table_name = ?", [table_name]).fetchone()
+    columns = dict((column[0], column[1]) for column in conn.execute(f"DESCRIBE {rows_query}").fetchall())
+    if state is None or time_column not in columns:
+        return
+    month = month_expression(f'"{time_column}"')
+    conn.execute(f"""
+    INSERT INTO {SKETCH_SCHEMA}.pending
+    SELECT DISTINCT ?, {month} FROM ({rows_query})
+    WHERE "{time_column}" < CAST(? AS {columns[time_column]})
+    EXCEPT SELECT table_name, month FROM {SKETCH_SCHEMA}.pending;
+    """, [table_name, state[0]])
+
+
+def update_sketches(conn, table_name, metrics, group_column, time_column, where=None, removed=None):
+    # Only rows from the watermark on and rows of the pending months are added, the sketches of older rows are kept
+    # as they are. removed is a relation with the rows taken out of the table after they were counted, e.g. by the
+    # rules the sketches feed: its rows of the watermark time and of the pending months are counted again with the table
+    create_sketch_tables(conn, table_name)
+    time_type = dict((column[0], column[1]) for column in conn.execute(f"DESCRIBE {table_name}").fetchall())[time_column]
+    state = conn.execute(f"SELECT watermark FROM {SKETCH_SCHEMA}.state WHERE table_name = ?", [table_name]).fetchone()
+    watermark = state[0] if state else None
+
+    # Rows of the watermark time can arrive in a later run, that time is counted again from scratch
+    if watermark:
+        conn.execute(f"""
+        UPDATE {SKETCH_SCHEMA}.{table_name} s SET count = s.count - b.count
+        FROM {SKETCH_SCHEMA}.boundary b
+        WHERE b.table_name = ? AND b.group_key = s.group_key AND b.month = s.month AND b.metric = s.metric AND b.bucket = s.bucket;
+        """, [table_name])
+        conn.execute(f"DELETE FROM {SKETCH_SCHEMA}.{table_name} WHERE count <= 0")
+    conn.execute(f"DELETE FROM {SKETCH_SCHEMA}.boundary WHERE table_name = ?", [table_name])
+
+    # Pending months are dropped from the sketch and counted again with all their rows
+    month = month_expression(f'"{time_column}"')
+    pending = f"{month} IN (SELECT month FROM {SKETCH_SCHEMA}.pending WHERE table_name = '{table_name}')"
+    conn.execute(f"DELETE FROM {SKETCH_SCHEMA}.{table_name} WHERE month IN (SELECT month FROM {SKETCH_SCHEMA}.pending WHERE table_name = ?)", [table_name])
+
+    filters = [f'"{group_column}" IS NOT NULL', f'"{time_column}" IS NOT NULL']
+    if where:
+        filters.append(f"({where})")
+    columns = ', '.join([f'"{group_column}"', f'"{time_column}"'] + [f'"{metric}"' for metric in metrics])
+    rows = f"SELECT {columns} FROM {table_name} WHERE {' AND '.join(filters)}"
+    parameters = []
+    if watermark:
+        rows += f' AND ("{time_column}" >= CAST(? AS {time_type}) OR {pending})'
+        parameters.append(watermark)
+        if removed:
+            rows += f' UNION ALL SELECT {columns} FROM {removed} WHERE {" AND ".join(filters)} AND ("{time_column}" = CAST(? AS {time_type}) OR {pending})'
+            parameters.append(watermark)
+
+    values = ', '.join(f'CAST("{metric}" AS DOUBLE) AS "{metric}"' for metric in metrics)
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE sketch_delta AS
+    SELECT group_key, month, time_value, metric, {bucket_expression('value')} AS bucket, COUNT(*) AS count
+    FROM (
+        UNPIVOT (
+            SELECT CAST("{group_column}" AS VARCHAR) AS group_key,
+                   {month} AS month,
+                   "{time_column}" AS time_value,
+                   {values}
+            FROM ({rows})
+        )
+        ON {', '.join(f'"{metric}"' for metric in metrics)}
+        INTO NAME metric VALUE value
+    )
+    WHERE value > 0
+    GROUP BY ALL;
+    """, parameters)
+    added = conn.execute(f"""
+    INSERT INTO {SKETCH_SCHEMA}.{table_name}
+    SELECT group_key, month, metric, bucket, SUM(count) FROM sketch_delta GROUP BY ALL
+    ON CONFLICT DO UPDATE SET count = count + EXCLUDED.count;
+    """).fetchone()[0]
+
+    # The watermark never moves back, even when the latest rows are removed from the table later
+    # or only rows of pending months were added
+    latest = conn.execute(f"SELECT CAST(GREATEST(MAX(time_value), CAST(? AS {time_type})) AS VARCHAR) FROM sketch_delta", [watermark]).fetchone()[0]
+    conn.execute(f"""
+    INSERT INTO {SKETCH_SCHEMA}.boundary
+    SELECT ?, group_key, month, metric, bucket, SUM(count) FROM sketch_delta
+    WHERE time_value = CAST(? AS {time_type})
+    GROUP BY ALL;
+    """, [table_name, latest])
+    conn.execute(f"INSERT OR REPLACE INTO {SKETCH_SCHEMA}.state VALUES (?, ?, current_timestamp)", [table_name, latest])
+    conn.execute(f"DELETE FROM {SKETCH_SCHEMA}.pending WHERE table_name = ?", [table_name])
+    conn.execute("DROP TABLE sketch_delta")
+    return added
+
+
+def quantiles_query(table_name, group_columns, quantiles, sketch_table=None):
+    # Sketches are merged to the requested grouping by summing their bucket counts.
+    # sketch_table reads another table with the same columns instead of the sketch of table_name
+    sketch_table = sketch_table or f"{SKETCH_SCHEMA}.{table_name}"
+    partition = ', '.join(group_columns + ['metric'])
+    selected = ', '.join(group_columns + ['metric'])
+    quantile_columns = ', '.join(
+        f"{bucket_value(f'MIN(bucket) FILTER (WHERE cumulative > {q} * (total - 1))')} AS q{int(q * 100)}"
+        for q in quantiles)
+    return f"""
+    SELECT {selected}, ANY_VALUE(total) AS total, {quantile_columns}
+    FROM (
+        SELECT *, SUM(count) OVER (PARTITION BY {partition} ORDER BY bucket) AS cumulative,
+                  SUM(count) OVER (PARTITION BY {partition}) AS total
+        FROM (SELECT {selected}, bucket, SUM(count) AS count FROM {sketch_table} GROUP BY ALL)
+    )
+    GROUP BY {selected}
+    """
+
+
+def create_iqr_bounds(conn, table_name, metrics, bounds_table='robust_bounds', min_count=MIN_GROUP_COUNT):
+    # metrics maps each metric to its k, bounds are [Q1 - k * IQR, Q3 + k * IQR] per group and month
+    levels = {
+        'month': quantiles_query(table_name, ['group_key', 'month'], [0.25, 0.75]),
+        'all_months': quantiles_query(table_name, ['group_key'], [0.25, 0.75]),
+        'table': quantiles_query(table_name, [], [0.25, 0.75]),
+    }
+    # The finest level with enough values is used
+    q1 = "CASE WHEN m.total >= {n} THEN m.q25 WHEN g.total >= {n} THEN g.q25 ELSE t.q25 END".format(n=min_count)
+    q3 = "CASE WHEN m.total >= {n} THEN m.q75 WHEN g.total >= {n} THEN g.q75 ELSE t.q75 END".format(n=min_count)
+    bounds = []
+    for metric, k in metrics.items():
+        bounds.append(f"MAX({q1} - {k} * ({q3} - {q1})) FILTER (WHERE m.metric = '{metric}') AS \"lower_{metric}\"")
+        bounds.append(f"MAX({q3} + {k} * ({q3} - {q1})) FILTER (WHERE m.metric = '{metric}') AS \"upper_{metric}\"")
+
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE {bounds_table} AS
+    SELECT m.group_key, m.month, {', '.join(bounds)}
+    FROM ({levels['month']}) m
+    JOIN ({levels['all_months']}) g ON g.group_key = m.group_key AND g.metric = m.metric
+    JOIN ({levels['table']}) t ON t.metric = m.metric
+    GROUP BY m.group_key, m.month;
+    """)
@@ -1,13 +1,20 @@
 import requests
+import aiohttp
+import asyncio
 import base64
-import pandas as pd
 import numpy as np
 import json
 import os
+import io
+import gzip
+import time
 from dotenv import load_dotenv, find_dotenv
 from datetime import datetime
+from scripts.api_scheduler import RequestScheduler, QuotaExceeded
 
 DESTINATION_FOLDER = "./temporal_landing"
+TOKEN_CACHE_PATH = "./.idealista_token.json"
+TOKEN_EXPIRY_MARGIN = 60     # Renew the cached token this many seconds before it expires
 
 def load_credentials():
     load_dotenv()
@@ -28,7 +35,7 @@ def load_credentials():
     return base64.b64encode(credentials.encode()).decode()
 
 
-def get_api_token(encoded_credentials):
+def request_token_data(encoded_credentials):
     # url where we will request the token
     token_url = "https://api.idealista.com/oauth/token"
 
@@ -53,7 +60,42 @@ def get_api_token(encoded_credentials):
     else:
         print("Error:", response.status_code, response.text)
 
-    return token_data["access_token"]
+    return token_data
+
+
+def get_api_token(encoded_credentials):
+    return request_token_data(encoded_credentials)["access_token"]
+
+
+def load_cached_token(cache_path=TOKEN_CACHE_PATH):
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path) as cache_file:
+        cached = json.load(cache_file)
+
+    # Only reuse the token while it is still valid
+    if cached["expires_at"] - TOKEN_EXPIRY_MARGIN > time.time():
+        return cached["access_token"]
+    return None
+
+
+def save_cached_token(token_data, cache_path=TOKEN_CACHE_PATH):
+    cached = {"access_token": token_data["access_token"],
+              "expires_at": time.time() + token_data["expires_in"]}
+
+    # The token is a secret, keep the cache readable only by the owner
+    with os.fdopen(os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_file:
+        json.dump(cached, cache_file)
+
+
+def get_cached_api_token(cache_path=TOKEN_CACHE_PATH):
+    access_token = load_cached_token(cache_path)
+    if access_token is None:
+        credentials = load_credentials()
+        token_data = request_token_data(credentials)
+        save_cached_token(token_data, cache_path)
+        access_token = token_data["access_token"]
+    return access_token
 
 # Detailing the parameters
 base_url = 'https://api.idealista.com/3.5/'  # Base search url
@@ -67,11 +109,18 @@ center = '41.3851,2.1734'     # Coordinates of the search center
 distance = '90000'     # Max distance from the center
 sort = 'desc'     # How to sort the found items
 maxprice = '100000'     # Max price of the listings
+max_pages = 50     # Max pages per search, the crawl stops earlier if the API reports fewer totalPages
+max_concurrency = 8     # Max pages requested at the same time
+requests_per_second = 1     # Per-second quota of the API
+monthly_quota = 100     # Monthly quota of the API
+landing_compression = 'gzip'     # Compression of the landing files (None, 'gzip', 'zstd')
+
+LANDING_EXTENSIONS = {None: 'ndjson', 'gzip': 'ndjson.gz', 'zstd': 'ndjson.zst'}
 
 # Creating the URL with the parameteres I want 
 
-def define_search_url():
-    url = (base_url +
+def define_search_url(api_url=base_url):
+    url = (api_url +
            country +
            '/search?operation=' + operation +
            '&maxItems=' + max_items +
@@ -87,8 +136,6 @@ def define_search_url():
 
 
 def search_api(url, access_token):
-    url = define_search_url()
-
     headers = {'Content-Type': "application/json",   # Define the search headers
                'Authorization' : 'Bearer ' + access_token}
 
@@ -99,53 +146,112 @@ def search_api(url, access_token):
     return result
 
 
-def results_to_df(results):
-    df = pd.DataFrame.from_dict(results['elementList'])
-    return df
-
-def concat_df(df, df_tot):
-    df_tot = pd.concat([df_tot, df])
-    return df_tot
+def create_scheduler():
+    return RequestScheduler(requests_per_second=requests_per_second, monthly_quota=monthly_quota)
 
-def df_to_json(df, file_path):
-    df = df.reset_index()  # Reset the index in order to organize the records
-    df.to_json(file_path, orient='records', indent=4)  # Save it as a JSON file
 
-def store_api_df(pages, url, access_token):
-    df_tot = pd.DataFrame()
-    for i in range(1, pages + 1):
-        url_copy = url  # Make a copy of the original URL
-        url_copy = url_copy % (i)  # Add the pagination to the copied URL
-        results = search_api(url_copy, access_token)  # Get the search results
-        df = results_to_df(results)  # Save the results as a dataframe
-        df_tot = concat_df(df, df_tot)  # Concatenate the results to the main dataframe
+async def fetch_page(session, url, page, access_token, semaphore, scheduler):
+    headers = {'Content-Type': "application/json",   # Define the search headers
+               'Authorization' : 'Bearer ' + access_token}
 
+    # The semaphore caps how many pages are in flight at the same time,
+    # the scheduler spaces them by the API quotas and retries 429/5xx responses
+    async with semaphore:
+        return await scheduler.send(lambda: session.post(url % (page), headers = headers))
+
+
+async def harvest_pages(url, access_token, handle_page, pages=max_pages, concurrency=max_concurrency, scheduler=None):
+    if scheduler is None:
+        scheduler = create_scheduler()
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)   # One pooled session for the whole crawl
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # The first page tells us how many pages the search has
+        first_page = await fetch_page(session, url, 1, access_token, semaphore, scheduler)
+        # Pages beyond the remaining monthly quota are not requested
+        total_pages = min(first_page.get('totalPages', 1), pages, 1 + scheduler.remaining())
+        handle_page(first_page)
+        handled_pages = 1
+
+        # Fetch the remaining pages concurrently and hand each one over as soon as it arrives
+        tasks = [asyncio.create_task(fetch_page(session, url, page, access_token, semaphore, scheduler)) for page in range(2, total_pages + 1)]
+        quota_exceeded = None
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    results = await task
+                except QuotaExceeded as e:
+                    # Retries can still use up the quota. Pages that get no slot fail before they are sent,
+                    # the requests already in flight were paid for and their pages are still kept
+                    quota_exceeded = e
+                    continue
+                handle_page(results)
+                handled_pages += 1
+        finally:
+            # When a page fails the pending ones are cancelled before the session closes
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    if quota_exceeded:
+        print(f"{quota_exceeded}, stopping after {handled_pages} of {total_pages} pages")
+    return handled_pages
+
+
+def harvest(url, access_token, handle_page, pages=max_pages, concurrency=max_concurrency, scheduler=None):
+    return asyncio.run(harvest_pages(url, access_token, handle_page, pages, concurrency, scheduler))
+
+
+def open_landing_file(file_path, compression=landing_compression):
+    if compression == 'gzip':
+        return gzip.open(file_path, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        import zstandard  # Optional dependency, only needed for zstd landing files
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(file_path, 'wb')), encoding='utf-8')
+    return open(file_path, 'w', encoding='utf-8')
+
+
+def write_page(landing_file, results):
+    # One listing per line, so DuckDB can read the file with format='newline_delimited'
+    for element in results['elementList']:
+        landing_file.write(json.dumps(element) + '\n')
+    return len(results['elementList'])
+
+
+def store_api_df(pages, url, access_token, concurrency=max_concurrency, scheduler=None, compression=landing_compression):
     # Get the current date in 'YYYY_MM_DD' format
     current_date = datetime.now().strftime("%Y_%m_%d")
 
-    # Generate the JSON file name with the date
-    json_file_path = f"{DESTINATION_FOLDER}/{current_date}_idealista.json"
-    df_to_json(df_tot, json_file_path)
-    return json_file_path
+    # Generate the NDJSON file name with the date
+    extension = LANDING_EXTENSIONS[compression]
+    file_path = f"{DESTINATION_FOLDER}/{current_date}_idealista.{extension}"
+
+    # Pages are streamed to a partial file that is only renamed once the crawl finished,
+    # a crawl cut short by the monthly quota still publishes the pages it fetched
+    partial_path = f"{file_path}.part"
+    try:
+        with open_landing_file(partial_path, compression) as landing_file:
+            harvest(url, access_token, lambda results: write_page(landing_file, results), pages, concurrency, scheduler)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, file_path)
+    return file_path
 
 
 def run():
-    credentials = load_credentials()
-    access_token = get_api_token(credentials)
+    access_token = get_cached_api_token()
     
     url = define_search_url()
 
-    pagination = 1
-    first_search_url = url %(pagination)
-    file_path = store_api_df(1, url, access_token)
-    return f"Stored file {file_path}" 
+    scheduler = create_scheduler()
+    try:
+        file_path = store_api_df(max_pages, url, access_token, scheduler=scheduler)
+    except QuotaExceeded as e:
+        return f"{e}, requests: {scheduler.counters()}"
+    return f"Stored file {file_path}, requests: {scheduler.counters()}" 
 
 if __name__ == "__main__":
-    credentials = load_credentials()
-    access_token = get_api_token(credentials)
-    
-    url = define_search_url()
-
-    pagination = 1
-    first_search_url = url %(pagination)
-    store_api_df(1, url, access_token)
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -1,7 +1,16 @@
 import os
-from os import listdir
-from os.path import isfile, join, isdir
+from os.path import join
 import shutil
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, reflinks fall back to copies there
+    fcntl = None
 
 SOURCE = "temporal_landing"
 DESTINATION = "persistent_landing"
@@ -10,15 +19,108 @@ SOURCE_FOLDER = f"./{SOURCE}/"
 
 DESTINATION_FOLDER = f"./{DESTINATION}/"
 
-def getAllFilesRecursive(root):
-    files = [ join(root,f) for f in listdir(root) if isfile(join(root,f))]
-    dirs = [ d for d in listdir(root) if isdir(join(root,d))]
-    for d in dirs:
-        files_in_d = getAllFilesRecursive(join(root,d))
-        if files_in_d:
-            for f in files_in_d:
-                files.append(join(root,f))
-    return files
+# Hidden file, so the formatted zone loader does not pick it up as a datasource
+MANIFEST_PATH = f"{DESTINATION_FOLDER}.manifest.sqlite"
+
+# How files are promoted: 'copy', 'reflink', 'hardlink' or 'move'.
+# Every mode falls back to a copy when the filesystem does not support it.
+PROMOTION_MODE = 'reflink'
+PROMOTION_WORKERS = 8
+
+FICLONE = 0x40049409  # Linux ioctl that clones a file on copy-on-write filesystems (btrfs, xfs)
+
+def scan_files(root):
+    # scandir returns the entries with their type, only files need a stat
+    for entry in os.scandir(root):
+        if entry.is_dir():
+            yield from scan_files(entry.path)
+        elif entry.is_file() and not entry.name.startswith('.'):
+            yield entry.path, entry.stat()
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def temporary_path(dest_file_path):
+    # Hidden temporary file next to the destination, so the final rename is atomic
+    directory, filename = os.path.split(dest_file_path)
+    return os.path.join(directory, f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def copy_file(source_file_path, tmp_path):
+    shutil.copy2(source_file_path, tmp_path)
+
+
+def reflink_file(source_file_path, tmp_path):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source_file_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source_file_path, tmp_path)
+
+
+def hardlink_file(source_file_path, tmp_path):
+    os.link(source_file_path, tmp_path)
+
+
+def promote_file(source_file_path, dest_file_path, mode=PROMOTION_MODE):
+    if mode == 'move':
+        try:
+            # A rename within the same filesystem only touches metadata
+            os.replace(source_file_path, dest_file_path)
+            return 'move'
+        except OSError:
+            promote_file(source_file_path, dest_file_path, 'copy')
+            os.remove(source_file_path)
+            return 'copy'
+
+    tmp_path = temporary_path(dest_file_path)
+    try:
+        try:
+            {'copy': copy_file, 'reflink': reflink_file, 'hardlink': hardlink_file}[mode](source_file_path, tmp_path)
+        except OSError:
+            if mode == 'copy':
+                raise
+            # Different filesystems or no copy-on-write support
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            copy_file(source_file_path, tmp_path)
+            mode = 'copy'
+        # Readers only ever see complete files
+        os.replace(tmp_path, dest_file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return mode
+
+
+def open_manifest(manifest_path):
+    manifest = sqlite3.connect(manifest_path)
+    manifest.execute("""
+    CREATE TABLE IF NOT EXISTS manifest (
+        source_path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        content_hash TEXT,
+        destination_path TEXT,
+        promoted_at TEXT
+    );
+    """)
+    manifest.execute("CREATE INDEX IF NOT EXISTS manifest_content_hash ON manifest (content_hash);")
+    return manifest
+
+
+def record_file(manifest, source_file_path, stat, content_hash, dest_file_path):
+    manifest.execute("""
+    INSERT OR REPLACE INTO manifest (source_path, size, mtime_ns, content_hash, destination_path, promoted_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, (source_file_path, stat.st_size, stat.st_mtime_ns, content_hash, dest_file_path, datetime.now().isoformat()))
 
 
 def get_destination_folder(filename: str) -> str:
@@ -29,7 +131,7 @@ def get_destination_folder(filename: str) -> str:
 
 
 
-def copy_new_files(source_folder, destination_folder):
+def copy_new_files(source_folder, destination_folder, manifest_path=MANIFEST_PATH, mode=PROMOTION_MODE, workers=PROMOTION_WORKERS):
     # Ensure the source and destination folders exist
     if not os.path.exists(source_folder):
         print(f"Source folder '{source_folder}' does not exist.")
@@ -37,31 +139,84 @@ def copy_new_files(source_folder, destination_folder):
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)  # Create the destination folder if it doesn't exist
 
-    # Get the list of files in both source and destination folders
-    source_files = getAllFilesRecursive(source_folder)
-    dest_files = getAllFilesRecursive(destination_folder)
+    manifest = open_manifest(manifest_path)
 
-    num_files = 0
+    num_unchanged = 0
+    to_promote = []
+    # Files with the same content as a promoted or queued file, linked to its copy: (existing path, file)
+    to_link = []
+    queued = {}
+
+    for source_file_path, stat in scan_files(source_folder):
+        known = manifest.execute("SELECT size, mtime_ns, content_hash FROM manifest WHERE source_path = ?", (source_file_path,)).fetchone()
+
+        # Files with the same size and modification time are not read again
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            num_unchanged += 1
+            continue
 
-    # Copy files that are not already in the destination folder
-    for source_file_path in source_files:
         filename = os.path.basename(source_file_path)
+        content_hash = hash_file(source_file_path)
 
         subfolder = get_destination_folder(filename)
         
         destination_subfolder = join(destination_folder + subfolder)
-        if not os.path.exists(destination_subfolder):
-            os.makedirs(destination_subfolder)
-
         dest_file_path = os.path.join(destination_subfolder, filename)
-        # Only copy if the file does not exist in the destination folder
-        if not os.path.isfile(dest_file_path):
-            print(f"Copying {filename} to {destination_subfolder}")
-            shutil.copy2(source_file_path, dest_file_path)
-            num_files += 1
-        else:
+
+        # Same content already promoted, possibly under another name
+        duplicate = manifest.execute(
+            "SELECT destination_path FROM manifest WHERE content_hash = ? AND source_path != ? LIMIT 1",
+            (content_hash, source_file_path)
+        ).fetchone()
+
+        if known and known[2] == content_hash:
+            print(f"Skipping {filename}, content did not change")
+        elif content_hash in queued or (duplicate and os.path.isfile(duplicate[0])):
+            # The file name carries the snapshot date, so the duplicate still gets its own name
+            existing_path = queued.get(content_hash) or duplicate[0]
+            if existing_path != dest_file_path:
+                print(f"Linking {filename} to {existing_path}, same content")
+                os.makedirs(destination_subfolder, exist_ok=True)
+                to_link.append((existing_path, (source_file_path, stat, content_hash, dest_file_path)))
+                continue
+        elif not known and os.path.isfile(dest_file_path) and hash_file(dest_file_path) == content_hash:
+            # Promoted before the manifest existed
             print(f"Skipping {filename}, already exists in {destination_folder}")
-    return num_files
+        else:
+            if known:
+                print(f"Updating {filename} in {destination_subfolder}, content changed")
+            else:
+                print(f"Copying {filename} to {destination_subfolder}")
+            if not os.path.exists(destination_subfolder):
+                os.makedirs(destination_subfolder)
+            to_promote.append((source_file_path, stat, content_hash, dest_file_path))
+            queued[content_hash] = dest_file_path
+            continue
+
+        record_file(manifest, source_file_path, stat, content_hash, dest_file_path)
+        manifest.commit()
+
+    # Promote the new files in parallel, the manifest is only written from this thread
+    modes_used = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(promote_file, source_file_path, dest_file_path, mode): (source_file_path, stat, content_hash, dest_file_path)
+                   for source_file_path, stat, content_hash, dest_file_path in to_promote}
+        for future in as_completed(futures):
+            mode_used = future.result()
+            modes_used[mode_used] = modes_used.get(mode_used, 0) + 1
+            record_file(manifest, *futures[future])
+            manifest.commit()
+
+    # Duplicates share the bytes of the existing copy, a hardlink only adds a name
+    for existing_path, file in to_link:
+        mode_used = promote_file(existing_path, file[3], 'hardlink')
+        modes_used[mode_used] = modes_used.get(mode_used, 0) + 1
+        record_file(manifest, *file)
+        manifest.commit()
+
+    manifest.close()
+    print(f"{num_unchanged} files unchanged since the last run, promoted files by mode: {modes_used}")
+    return len(to_promote) + len(to_link)
 
 def extract_year_from_filename(filename):
     # Split the filename by underscores and take the first part
@@ -1,16 +1,35 @@
 from os.path import isfile, join, isdir
 import duckdb
 import os
+import shutil
+from scripts.script1 import hash_file
+from scripts.publishing import staged_database
+from scripts.connections import get_config
 
 DB_FOLDER = "./formatted_zone"
 DB_PATH = f"{DB_FOLDER}/formatted.db"
 SOURCE = './persistent_landing/'
 
+# How idealista snapshots are stored in the formatted zone:
+# 'per_snapshot' creates one table per landing file (idealista_31_10_2020, ...),
+# 'table' appends every snapshot to a single idealista table,
+# 'parquet' writes a hive partitioned dataset by year/month/snapshot_date exposed through an idealista view.
+# The last two add a snapshot_date column.
+IDEALISTA_LAYOUT = 'per_snapshot'
+PARQUET_FOLDER = f"{DB_FOLDER}/idealista"
+
+# With bulk ingestion the pending idealista snapshots of the 'table' and 'parquet' layouts
+# are loaded with one multi-file scan per file format instead of one scan per file
+BULK_INGEST = False
+
+SNAPSHOT_PATTERN = r'(\d{4}_\d{2}_\d{2})_idealista[^/]*$'
+
 def getAllFilesRecursive(root):
     try:
         root = os.path.normpath(root)
         
-        files = [join(root, f) for f in os.listdir(root) if isfile(join(root, f))]
+        # Hidden files hold metadata such as the landing manifest, not data
+        files = [join(root, f) for f in os.listdir(root) if isfile(join(root, f)) and not f.startswith('.')]
         dirs = [d for d in os.listdir(root) if isdir(join(root, d))]
 
         for d in dirs:
@@ -22,37 +41,222 @@ def getAllFilesRecursive(root):
     except FileNotFoundError:
         raise FileNotFoundError
 
-def load_database():
+def get_file_format(file):
+    extensions = os.path.basename(file).split('.')[1:]
+    # Compressed files are detected by DuckDB, the format is the extension before it
+    if extensions[-1] in ('gz', 'zst'):
+        extensions = extensions[:-1]
+    return extensions[-1]
+
+def get_read_function(file):
+    file_format = get_file_format(file)
+    if file_format == 'xlsx':
+        return f"st_read('{file}')"
+    if file_format == 'ndjson':
+        return f"read_json('{file}', format='newline_delimited')"
+    return f"read_{file_format}('{file}')"
+
+def get_scan_function(files):
+    # Scans several files of the same format at once, keeping the file of every row
+    file_list = ', '.join(f"'{file}'" for file in files)
+    file_format = get_file_format(files[0])
+    if file_format == 'ndjson':
+        return f"read_json([{file_list}], format='newline_delimited', union_by_name = true, filename = true)"
+    return f"read_{file_format}([{file_list}], union_by_name = true, filename = true)"
+
+def create_ledger(con):
+    # Records which landing file produced which table, so only new or changed files are loaded
+    con.sql("""
+        CREATE TABLE IF NOT EXISTS ingestion_ledger (
+            file_path VARCHAR PRIMARY KEY,
+            size BIGINT,
+            mtime_ns BIGINT,
+            content_hash VARCHAR,
+            table_name VARCHAR,
+            row_count BIGINT,
+            ingested_at TIMESTAMP
+        );
+        """)
+
+def get_pending_files(con, files):
+    ledger = {row[0]: row[1:] for row in con.execute("SELECT file_path, size, mtime_ns, content_hash FROM ingestion_ledger").fetchall()}
+    pending = []
+    for file in files:
+        stat = os.stat(file)
+        known = ledger.get(file)
+        # Files with the same size and modification time are not read again
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            continue
+        content_hash = hash_file(file)
+        if known and known[2] == content_hash:
+            # Touched but not changed, only refresh its stat
+            con.execute("UPDATE ingestion_ledger SET size = ?, mtime_ns = ? WHERE file_path = ?", [stat.st_size, stat.st_mtime_ns, file])
+            continue
+        pending.append((file, stat, content_hash, known is not None))
+    return pending
+
+def is_idealista_snapshot(file):
+    stem = os.path.basename(file).split('.')[0]
+    return stem.split('_')[-1] == 'idealista' and stem.split('_')[0].isdigit()
+
+def get_snapshot_query(con, files, partition_columns=False):
+    scan_function = get_scan_function(files)
+
+    # Nested columns change shape between snapshots, they are kept as JSON so every snapshot fits the same schema
+    columns = con.execute(f"DESCRIBE SELECT * FROM {scan_function}").fetchall()
+    nested = [column[0] for column in columns if column[1].startswith(('STRUCT', 'MAP')) or column[1].endswith(']')]
+    replace = ''
+    if nested:
+        replace = ' REPLACE (' + ', '.join(f'to_json("{name}") AS "{name}"' for name in nested) + ')'
+
+    # The snapshot date comes from the landing file name
+    partitions = ', year(snapshot_date) AS year, month(snapshot_date) AS month' if partition_columns else ''
+    return f"""
+        SELECT *, strftime(snapshot_date, '%Y-%m-%d') AS timestamp{partitions}
+        FROM (
+            SELECT * EXCLUDE (filename){replace},
+                CAST(strptime(regexp_extract(filename, '{SNAPSHOT_PATTERN}', 1), '%Y_%m_%d') AS DATE) AS snapshot_date,
+                filename AS source_file
+            FROM {scan_function}
+        )
+        """
+
+def get_common_type(con, type_a, type_b):
+    # DuckDB resolves the type a list of both would have, e.g. BIGINT and DOUBLE give DOUBLE
     try:
-        files = getAllFilesRecursive(SOURCE)
-        table_number = 0
-        with duckdb.connect(DB_PATH) as con:
-            con.sql("""
-                INSTALL spatial;
-                LOAD spatial;
-                """)
-            for file in files:
-                file = file.replace("\\", "/")
-                filename = os.path.basename(file).split('.')
-                read_function = f'read_{filename[-1]}'
-                if filename[-1] == 'xlsx':
-                    read_function = 'st_read'
-                table_name = '_'.join(filename[0].split('_')[::-1])
-                con.sql(f"CREATE TABLE IF NOT EXISTS {table_name} AS FROM {read_function}('{file}');")
-                print(f"Reading file {filename[0]}")
-                table_number += 1
-                if filename[0].split('_')[0].isdigit():
-                    con.sql(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS timestamp VARCHAR DEFAULT '{'-'.join(filename[0].split('_')[:-1])}';")
-        return f"Formatting was executed correctly, database has {table_number} tables"
+        return con.execute(f"SELECT typeof([CAST(NULL AS {type_a}), CAST(NULL AS {type_b})])").fetchone()[0][:-2]
+    except duckdb.Error:
+        return 'VARCHAR'
+
+def count_rows_by_file(con, relation, files):
+    counts = dict(con.execute(f"SELECT source_file, COUNT(*) FROM {relation} WHERE source_file IN (SELECT UNNEST(?)) GROUP BY source_file", [files]).fetchall())
+    return {file: counts.get(file, 0) for file in files}
+
+def load_snapshots_into_table(con, files):
+    query = get_snapshot_query(con, files)
+    tables = [table[0] for table in con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()]
+    if 'idealista' not in tables:
+        con.sql(f"CREATE TABLE idealista AS {query};")
+    else:
+        # New snapshots may bring new columns or wider types
+        existing_columns = {column[0]: column[1] for column in con.execute("DESCRIBE idealista").fetchall()}
+        for name, column_type, *_ in con.execute(f"DESCRIBE {query}").fetchall():
+            column_type = 'VARCHAR' if column_type == 'NULL' else column_type
+            if name not in existing_columns:
+                con.sql(f'ALTER TABLE idealista ADD COLUMN "{name}" {column_type};')
+            elif existing_columns[name] != column_type:
+                common_type = get_common_type(con, existing_columns[name], column_type)
+                if common_type != existing_columns[name]:
+                    con.sql(f'ALTER TABLE idealista ALTER "{name}" TYPE {common_type};')
+
+        # Changed files replace the rows they loaded before, DuckDB needs the schema changes to come first
+        con.execute("DELETE FROM idealista WHERE source_file IN (SELECT UNNEST(?))", [files])
+        con.sql(f"INSERT INTO idealista BY NAME {query};")
+    return count_rows_by_file(con, 'idealista', files)
+
+def load_snapshots_into_parquet(con, files):
+    # Every snapshot has its own partition, a changed file rewrites only that one
+    for file in files:
+        stem = os.path.basename(file).split('.')[0]
+        year, month, day = stem.split('_')[:3]
+        partition = f"{PARQUET_FOLDER}/year={int(year)}/month={int(month)}/snapshot_date={year}-{month}-{day}"
+        if os.path.exists(partition):
+            shutil.rmtree(partition)
+
+    con.sql(f"""
+        COPY ({get_snapshot_query(con, files, partition_columns=True)}) TO '{PARQUET_FOLDER}'
+        (FORMAT parquet, COMPRESSION zstd, PARTITION_BY (year, month, snapshot_date), OVERWRITE_OR_IGNORE);
+        """)
+
+    # year and month only exist to partition the files, snapshot_date already carries the date.
+    # The columns keep the order of the 'table' layout
+    con.sql(f"""
+        CREATE OR REPLACE VIEW idealista AS
+        SELECT * EXCLUDE (year, month, snapshot_date, source_file, timestamp), snapshot_date, source_file, timestamp
+        FROM read_parquet('{PARQUET_FOLDER}/*/*/*/*.parquet', hive_partitioning = true, union_by_name = true);
+        """)
+    return count_rows_by_file(con, 'idealista', files)
+
+def load_snapshots(con, files, layout=IDEALISTA_LAYOUT):
+    for file in files:
+        print(f"Reading file {os.path.basename(file).split('.')[0]}")
+    if layout == 'table':
+        return load_snapshots_into_table(con, files)
+    return load_snapshots_into_parquet(con, files)
+
+def load_file(con, file):
+    filename = os.path.basename(file).split('.')
+    print(f"Reading file {filename[0]}")
+    table_name = '_'.join(filename[0].split('_')[::-1])
+    con.sql(f"CREATE OR REPLACE TABLE {table_name} AS FROM {get_read_function(file)};")
+    if filename[0].split('_')[0].isdigit():
+        con.sql(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS timestamp VARCHAR DEFAULT '{'-'.join(filename[0].split('_')[:-1])}';")
+    row_count = con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    return table_name, row_count
+
+def record_ingestion(con, file, stat, content_hash, table_name, row_count):
+    con.execute("INSERT OR REPLACE INTO ingestion_ledger VALUES (?, ?, ?, ?, ?, ?, current_timestamp)",
+                [file, stat.st_size, stat.st_mtime_ns, content_hash, table_name, row_count])
+
+def group_snapshots(snapshots, bulk=BULK_INGEST):
+    if not bulk:
+        return [[snapshot] for snapshot in snapshots]
+    # One multi-file scan per file format
+    groups = {}
+    for snapshot in snapshots:
+        groups.setdefault(get_file_format(snapshot[0]), []).append(snapshot)
+    return list(groups.values())
+
+def load_database(layout=IDEALISTA_LAYOUT, bulk=BULK_INGEST, db_path=DB_PATH):
+    try:
+        files = [file.replace("\\", "/") for file in getAllFilesRecursive(SOURCE)]
+        # Threads and memory come from DUCKDB_THREADS and DUCKDB_MEMORY_LIMIT, like every other stage
+        with duckdb.connect(db_path, config=get_config()) as con:
+            create_ledger(con)
+            pending = get_pending_files(con, files)
+
+            # The spatial extension is only needed to read excel files
+            if any(file.endswith('.xlsx') for file, _, _, _ in pending):
+                con.sql("""
+                    INSTALL spatial;
+                    LOAD spatial;
+                    """)
+
+            snapshots = []
+            if layout != 'per_snapshot':
+                snapshots = [file for file in pending if is_idealista_snapshot(file[0])]
+
+            for group in group_snapshots(snapshots, bulk):
+                # The snapshots and their ledger entries are written together
+                con.begin()
+                row_counts = load_snapshots(con, [file for file, _, _, _ in group], layout)
+                for file, stat, content_hash, changed in group:
+                    record_ingestion(con, file, stat, content_hash, 'idealista', row_counts[file])
+                con.commit()
+
+            snapshot_files = {file for file, _, _, _ in snapshots}
+            for file, stat, content_hash, changed in pending:
+                if file in snapshot_files:
+                    continue
+                # The table and its ledger entry are written together
+                con.begin()
+                table_name, row_count = load_file(con, file)
+                record_ingestion(con, file, stat, content_hash, table_name, row_count)
+                con.commit()
+
+            new_files = len([file for file in pending if not file[3]])
+            changed_files = len(pending) - new_files
+            table_number = con.execute("SELECT COUNT(DISTINCT table_name) FROM ingestion_ledger").fetchone()[0]
+        return f"Formatting was executed correctly, loaded {new_files} new and {changed_files} changed files, {len(files) - len(pending)} unchanged, database has {table_number} tables"
     except FileNotFoundError:
         return f"Source path {SOURCE} not found"
 def run():
     if not os.path.exists(DB_FOLDER):
         os.makedirs(DB_FOLDER)  # Create the destination folder if it doesn't exist
 
-    return load_database()
+    # Built on a staging copy, readers keep the last good database until it is swapped in
+    with staged_database(DB_PATH) as staging:
+        return load_database(db_path=staging)
 
 if __name__ == "__main__":
-    if not os.path.exists(DB_FOLDER):
-        os.makedirs(DB_FOLDER)  # Create the destination folder if it doesn't exist
-    load_database()
\ No newline at end of file
+    run()
\ No newline at end of file
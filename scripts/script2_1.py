@@ -4,12 +4,14 @@ import re
 from datetime import datetime
 import pandas as pd
 from customized_profiling import customized_profiling
+from scripts.script3 import UNWANTED_COLUMNS
+from scripts.connections import get_connection
 
 DB_PATH = './formatted_zone/formatted.db'
 
 
-def create_connection(path):
-    return duckdb.connect(path)
+def create_connection(path, read_only=False):
+    return get_connection(path, read_only)
 
 
 def data_profiling(db_path, output_dir):
@@ -17,8 +19,8 @@ def data_profiling(db_path, output_dir):
         os.makedirs(output_dir)
     try:
         # Connect to the DuckDB database
-        conn = duckdb.connect(db_path)
-    except FileNotFoundError:
+        conn = create_connection(db_path, read_only=True)
+    except (FileNotFoundError, duckdb.IOException):
         print("Database folder does not exist")
         return
     # Get list of all tables in the database
@@ -39,21 +41,24 @@ def data_profiling(db_path, output_dir):
                 latest_date = table_date
                 latest_table = table_name
     
+    query = f"SELECT * FROM {latest_table}"
+
+    # Snapshots stored in a single idealista table or parquet dataset, only the latest one is read
+    if latest_table is None and ('idealista',) in tables:
+        latest_date = conn.execute("SELECT MAX(snapshot_date) FROM idealista").fetchone()[0]
+        if latest_date is not None:
+            latest_table = f"idealista_{latest_date.strftime('%d_%m_%Y')}"
+            query = f"SELECT * FROM idealista WHERE snapshot_date = DATE '{latest_date}'"
+
     # Profile the latest table if found
     if latest_table:
         print(f"Reading and profiling table: {latest_table}")
         try:
             # Read the table into a DataFrame
-            df = conn.execute(f"SELECT * FROM {latest_table}").fetchdf()
+            df = conn.execute(query).fetchdf()
             
             # Remove unwanted columns if they exist
-            keyword_list = [
-                'thumbnail','externalReference','numPhotos','showAddress',
-                'url','distance','hasVideo','detailedType','suggestedTexts',
-                'hasPlan','has3DTour','has360','hasStaging','topNewDevelopment',
-                'parkingSpace','json','index','priceInfo','description',
-                'topPlus','highlight','newDevelopmentFinished'
-            ]
+            keyword_list = UNWANTED_COLUMNS['idealista']
             df = df.drop(columns=[col for col in keyword_list if col in df.columns], errors='ignore')
             
             # Convert unhashable types (e.g., dict) to string
@@ -1,8 +1,14 @@
 import duckdb
-import pandas as pd
-import numpy as np
 import os
 
+from scripts import script3_2, script3_3, script3_4
+from scripts.script3_2 import reset_dedup_state, rewind_dedup_state
+from scripts.script3_3 import get_formatting_query
+from scripts.script3_4 import reset_quarantine, ROBUST_TIME_COLUMN
+from scripts.quantile_sketch import reset_sketches, rewind_sketches
+from scripts.publishing import staged_database
+from scripts.connections import get_config
+
 SOURCE_FOLDER = "./formatted_zone"
 DESTINATION_FOLDER = "./trusted_zone"
 
@@ -10,97 +16,189 @@ SOURCE_DB = f"{SOURCE_FOLDER}/formatted.db"
 
 DESTINATION_DB = f"{DESTINATION_FOLDER}/trusted.db"
 
-def merge_tables_by_keyword(db_path, keyword):
-    # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
-    
-    # Query to get all table names containing the specified keyword
-    query = f"SELECT table_name FROM information_schema.tables WHERE table_name ILIKE '%{keyword}%';"
-    table_names = conn.execute(query).fetchall()
-
-    # Extract table names from query result
-    table_names = [name[0] for name in table_names]
-
-    # Read each table into a DataFrame and merge them
-    merged_df = pd.DataFrame()
-    for table_name in table_names:
-        try:
-            df = conn.execute(f'SELECT * FROM {table_name}').fetchdf()
-            merged_df = pd.concat([merged_df, df], ignore_index=True)
-        except Exception as e:
-            print(f"Error while processing table '{table_name}': {e}")
-
-    # Close the connection
-    conn.close()
-    
-    return merged_df
-
-def save_merged_table_to_new_db(merged_df, new_db_path, table_name):
-    # Connect to the new DuckDB database
-    conn = duckdb.connect(new_db_path)
-    
-    # Drop the table if it exists
-    conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-    
-    # Replace problematic objects with NaN to avoid type conversion issues
-    merged_df = merged_df.applymap(lambda x: np.nan if isinstance(x, dict) else x)
-    
-    # Save the merged DataFrame to the new database
-    conn.register('merged_df', merged_df)
-    conn.execute(f"CREATE TABLE {table_name} AS SELECT * FROM merged_df")
-    
-    # Close the connection
-    conn.close()
+# Event time of the merged rows, recorded per source in the merge ledger
+TIME_COLUMN = 'timestamp'
+
+# Columns that are never materialized in the trusted zone, per table
+UNWANTED_COLUMNS = {
+    'idealista': [
+        'thumbnail','externalReference','numPhotos','showAddress',
+        'url','distance','hasVideo','detailedType','suggestedTexts',
+        'hasPlan','has3DTour','has360','hasStaging','topNewDevelopment',
+        'parkingSpace','json','index','priceInfo','description',
+        'topPlus','highlight','newDevelopmentFinished'
+    ]
+}
+
+def get_projection(columns, unwanted):
+    # columns are (name, type) pairs, unwanted columns are excluded and
+    # struct and map columns are replaced by NULL to avoid type conversion issues
+    excluded = [name for name, data_type in columns if name in unwanted]
+    nested = [name for name, data_type in columns if name not in unwanted and data_type.startswith(('STRUCT', 'MAP'))]
+
+    projection = '*'
+    if excluded:
+        projection += ' EXCLUDE (' + ', '.join(f'"{name}"' for name in excluded) + ')'
+    if nested:
+        projection += ' REPLACE (' + ', '.join(f'CAST(NULL AS VARCHAR) AS "{name}"' for name in nested) + ')'
+    return projection
+
+def get_table_names(conn, keyword):
+    # Query to get all table names of the attached formatted zone containing the specified keyword
+    table_names = conn.execute("""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_catalog = 'formatted' AND table_schema = 'main' AND table_name ILIKE ?
+        ORDER BY table_name;
+        """, [f'%{keyword}%']).fetchall()
+    return [table_name for (table_name,) in table_names]
+
+def get_columns(conn, table_name):
+    return conn.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_catalog = 'formatted' AND table_schema = 'main' AND table_name = ?;
+        """, [table_name]).fetchall()
+
+def get_sources(conn, keyword):
+    # Formatted tables and landing files the trusted table is merged from, with their content hash:
+    # a table per snapshot, or a file of the single idealista table of the 'table' and 'parquet' layouts
+    has_ledger = 'ingestion_ledger' in get_table_names(conn, 'ingestion_ledger')
+    sources = {}
+    for table_name in get_table_names(conn, keyword):
+        ledger = conn.execute("SELECT file_path, content_hash FROM formatted.ingestion_ledger WHERE table_name = ? ORDER BY file_path", [table_name]).fetchall() if has_ledger else []
+        if 'source_file' in [name for name, _ in get_columns(conn, table_name)] and ledger:
+            sources.update({(table_name, file_path): content_hash for file_path, content_hash in ledger})
+        else:
+            sources[(table_name, '')] = ','.join(content_hash for _, content_hash in ledger) or None
+    return sources
+
+def merge_tables_by_keyword(conn, keyword, sources=None):
+    # sources limits the merge to some formatted tables and files, all tables are merged by default
+    selects = []
+    for table_name in get_table_names(conn, keyword):
+        files = [file_path for source_table, file_path in sources if source_table == table_name] if sources is not None else ['']
+        if not files:
+            continue
+
+        # Unwanted columns are left out of the scan, they are never read
+        projection = get_projection(get_columns(conn, table_name), UNWANTED_COLUMNS.get(keyword, []))
+        select = f'SELECT {projection} FROM formatted."{table_name}"'
+        if '' not in files:
+            select += ' WHERE source_file IN (' + ', '.join("'" + file_path.replace("'", "''") + "'" for file_path in files) + ')'
+        selects.append(select)
+
+    # Columns are matched by name, tables without a column get NULLs
+    return '\nUNION ALL BY NAME\n'.join(selects)
+
+def create_merge_ledger(conn):
+    # Sources already merged into each trusted table, in their own schema like the other stage states
+    conn.execute("CREATE SCHEMA IF NOT EXISTS merged;")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS merged.sources (
+        table_name VARCHAR,
+        source_table VARCHAR,
+        source_file VARCHAR,
+        content_hash VARCHAR,
+        merged_at TIMESTAMP
+    );
+    """)
+    # Time range of the rows appended from a source, the exploitation load (script4) reads the rows of
+    # sources it has not loaded yet by it. NULL for sources merged by a rebuild.
+    conn.execute("ALTER TABLE merged.sources ADD COLUMN IF NOT EXISTS earliest_timestamp TIMESTAMP;")
+    conn.execute("ALTER TABLE merged.sources ADD COLUMN IF NOT EXISTS latest_timestamp TIMESTAMP;")
+
+def get_time_ranges(conn, keyword, sources):
+    # First and last timestamp of the formatted rows of every source
+    ranges = {}
+    for source in sources:
+        query = get_formatting_query(conn, merge_tables_by_keyword(conn, keyword, {source: None}), keyword)
+        if TIME_COLUMN in [column[0] for column in conn.execute(f"DESCRIBE {query}").fetchall()]:
+            ranges[source] = conn.execute(f'SELECT MIN("{TIME_COLUMN}"), MAX("{TIME_COLUMN}") FROM ({query})').fetchone()
+    return ranges
+
+def record_sources(conn, table_name, sources, ranges=None):
+    ranges = ranges or {}
+    conn.executemany("""
+        INSERT INTO merged.sources (table_name, source_table, source_file, content_hash, merged_at, earliest_timestamp, latest_timestamp)
+        VALUES (?, ?, ?, ?, current_timestamp, ?, ?)
+        """, [[table_name, source_table, source_file, content_hash, *ranges.get((source_table, source_file), (None, None))]
+              for (source_table, source_file), content_hash in sources.items()])
+
+def save_merged_table_to_new_db(conn, merge_query, table_name, sources):
+    # New rows are formatted as they are merged, so later snapshots can be appended to the table
+    # after consistent formatting (script3_3) ran on it
+    conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS {get_formatting_query(conn, merge_query, table_name)}")
+    # The rebuilt table has not been deduplicated or filtered yet
+    reset_dedup_state(conn, table_name)
+    reset_quarantine(conn, table_name)
+    reset_sketches(conn, table_name)
+    conn.execute("DELETE FROM merged.sources WHERE table_name = ?", [table_name])
+    record_sources(conn, table_name, sources)
+
+def append_to_table(conn, merge_query, table_name, sources):
+    # Only the new sources are read, the deduplication and outlier states of the table stay valid
+    query = get_formatting_query(conn, merge_query, table_name)
+    existing_columns = [column[0] for column in conn.execute(f"DESCRIBE {table_name}").fetchall()]
+    for name, column_type, *_ in conn.execute(f"DESCRIBE {query}").fetchall():
+        if name not in existing_columns:
+            conn.execute(f'ALTER TABLE {table_name} ADD COLUMN "{name}" {column_type};')
+    conn.execute(f"INSERT INTO {table_name} BY NAME {query}")
+    rewind_dedup_state(conn, table_name, query)
+    rewind_sketches(conn, table_name, query, ROBUST_TIME_COLUMN)
+    record_sources(conn, table_name, sources, get_time_ranges(conn, table_name, sources))
 
 def merge_and_save_all_groups(db_path, new_db_path):
     # Define the keywords to group tables by
     keywords = ['idealista', 'income']
-    
+
+    # The merge runs inside DuckDB, the formatted zone is attached to the new database
+    conn = duckdb.connect(new_db_path, config=get_config())
+    conn.execute(f"ATTACH '{db_path}' AS formatted (READ_ONLY)")
+    create_merge_ledger(conn)
+    trusted_tables = [table[0] for table in conn.execute("SELECT table_name FROM information_schema.tables WHERE table_catalog = current_database() AND table_schema = 'main';").fetchall()]
+
     for keyword in keywords:
-        # Merge tables by keyword
-        merged_df = merge_tables_by_keyword(db_path, keyword)
-        
-        # Save the merged DataFrame to the new database
-        save_merged_table_to_new_db(merged_df, new_db_path, table_name=keyword)
+        sources = get_sources(conn, keyword)
+        if not sources:
+            print(f"No tables found for keyword '{keyword}'")
+            continue
+
+        merged = dict(((source_table, source_file), content_hash) for source_table, source_file, content_hash in conn.execute(
+            "SELECT source_table, source_file, content_hash FROM merged.sources WHERE table_name = ?", [keyword]).fetchall())
+        new_sources = {source: content_hash for source, content_hash in sources.items() if source not in merged}
+        changed = [source for source, content_hash in merged.items() if sources.get(source, '') != content_hash]
+
+        if keyword not in trusted_tables or not merged or changed:
+            # First run, or sources were changed or removed: the table is rebuilt from every source
+            save_merged_table_to_new_db(conn, merge_tables_by_keyword(conn, keyword), keyword, sources)
+            print(f"Rebuilt table '{keyword}' from {len(sources)} sources")
+        elif new_sources:
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                append_to_table(conn, merge_tables_by_keyword(conn, keyword, new_sources), keyword, new_sources)
+                conn.execute("COMMIT")
+                print(f"Appended {len(new_sources)} new sources to table '{keyword}'")
+            except duckdb.Error as e:
+                # New rows that do not fit the table, e.g. a column changed its type
+                conn.execute("ROLLBACK")
+                print(f"Could not append to table '{keyword}' ({e}), rebuilding it")
+                save_merged_table_to_new_db(conn, merge_tables_by_keyword(conn, keyword), keyword, sources)
+        else:
+            print(f"No new sources for table '{keyword}'")
+
+    conn.execute("DETACH formatted")
+    conn.close()
 
 
 
 
 def drop_unwanted_columns(db_path, table_name):
-    # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
-    
-    # List of columns to drop
-    keyword_list = [
-        'thumbnail','externalReference','numPhotos','showAddress',
-        'url','distance','hasVideo','detailedType','suggestedTexts',
-        'hasPlan','has3DTour','has360','hasStaging','topNewDevelopment',
-        'parkingSpace','json','index','priceInfo','description',
-        'topPlus','highlight','newDevelopmentFinished'
-    ]
-    
-    # Iterate over the keyword list and drop each column if it exists
-    for keyword in keyword_list:
-        try:
-            conn.execute(f"ALTER TABLE {table_name} DROP COLUMN IF EXISTS {keyword}")
-        except Exception as e:
-            print(f"Error while dropping column '{keyword}': {e}")
-    
-    # Save the modified table to a new DataFrame
-    modified_df = conn.execute(f"SELECT * FROM {table_name}").fetchdf()
+    # Only needed for tables merged before the projection was applied at merge time
+    conn = duckdb.connect(db_path, config=get_config())
+    columns = [column[:2] for column in conn.execute(f"DESCRIBE {table_name}").fetchall()]
+    projection = get_projection(columns, UNWANTED_COLUMNS.get(table_name, []))
+    if projection != '*':
+        conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT {projection} FROM {table_name}")
     conn.close()
-    
-    for col in modified_df.select_dtypes(include=['object']).columns:
-        modified_df[col] = [np.nan if isinstance(x, dict) else x for x in modified_df[col]]
-    
-    # Connect to the output database and save the modified table
-    output_conn = duckdb.connect(db_path)
-    output_conn.register('modified_df', modified_df)
-
-    # Drop the table if it exists
-    output_conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-    output_conn.execute(f"CREATE TABLE {table_name} AS SELECT * FROM modified_df")
-    output_conn.close()
 
 def run():
     if not os.path.exists(SOURCE_DB):
@@ -108,14 +206,20 @@ def run():
     if not os.path.exists(DESTINATION_FOLDER):
         os.makedirs(DESTINATION_FOLDER)  # Create the destination folder if it doesn't exist
 
-    merge_and_save_all_groups(SOURCE_DB, DESTINATION_DB)
-    drop_unwanted_columns(DESTINATION_DB, 'idealista')
+    # Built on a staging copy, readers keep the last good database until it is swapped in
+    with staged_database(DESTINATION_DB) as staging:
+        merge_and_save_all_groups(SOURCE_DB, staging)
 
-if __name__ == "__main__":
+def run_all():
+    # Stages 3 to 3.4 on a single staging copy, the trusted zone is cloned and published once
     if not os.path.exists(SOURCE_DB):
-        exit
-    if not os.path.exists(DESTINATION_FOLDER):
-        os.makedirs(DESTINATION_FOLDER)  # Create the destination folder if it doesn't exist
+        return (f"File not found: {SOURCE_DB}")
+    with staged_database(DESTINATION_DB):
+        run()
+        script3_2.run()
+        script3_3.run()
+        outliers = script3_4.run()
+    return outliers
 
-    merge_and_save_all_groups(SOURCE_DB, DESTINATION_DB)
-    drop_unwanted_columns(DESTINATION_DB, 'idealista')
\ No newline at end of file
+if __name__ == "__main__":
+    run()
\ No newline at end of file
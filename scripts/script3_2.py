@@ -2,43 +2,194 @@ import duckdb
 import pandas as pd
 import os
 
+from scripts.publishing import staged_database
+from scripts.connections import get_config
 
-def deduplication(db_path):
+# Business keys per table. Each key lists the names the column can have,
+# before and after the consistent formatting renames them.
+DEDUP_KEYS = {
+    'idealista': [('propertyCode',), ('timestamp',)],
+    'income': [('neighborhood', 'Barris'), ('year', 'timestamp')],
+}
+
+# Column that orders the rows of a table, rows after the stored watermark are the newly arrived ones
+DEDUP_ORDER = {
+    'idealista': ('snapshot_date', 'timestamp'),
+    'income': ('year', 'timestamp'),
+}
+
+# Which row of a duplicated key is kept: 'latest' (latest snapshot wins) or 'first'
+DEDUP_TIE_BREAK = 'latest'
+
+
+def resolve_column(columns, candidates):
+    for candidate in candidates:
+        if candidate in columns:
+            return candidate
+    return None
+
+
+def create_dedup_state(conn):
+    # Kept in their own schema, the stages that list the tables of the zone do not see them
+    conn.execute("CREATE SCHEMA IF NOT EXISTS dedup;")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dedup.state (
+        table_name VARCHAR PRIMARY KEY,
+        key_signature VARCHAR,
+        watermark VARCHAR,
+        updated_at TIMESTAMP
+    );
+    """)
+
+
+def reset_dedup_state(conn, table_name):
+    # Called when a table is rebuilt, the next deduplication checks every row again
+    create_dedup_state(conn)
+    conn.execute("DELETE FROM dedup.state WHERE table_name = ?", [table_name])
+    conn.execute(f"DROP TABLE IF EXISTS dedup.index_{table_name}")
+
+
+def rewind_dedup_state(conn, table_name, rows_query):
+    # Called when rows are appended, rows older than the watermark (a late snapshot) are checked in the next deduplication
+    create_dedup_state(conn)
+    columns = {column[0]: column[1] for column in conn.execute(f"DESCRIBE {rows_query}").fetchall()}
+    order_column = resolve_column(columns, DEDUP_ORDER.get(table_name, ()))
+    if order_column is None:
+        return
+    order_type = columns[order_column]
+    earliest = conn.execute(f'SELECT CAST(MIN("{order_column}") AS VARCHAR) FROM ({rows_query})').fetchone()[0]
+    if earliest is not None:
+        conn.execute(f"UPDATE dedup.state SET watermark = ? WHERE table_name = ? AND CAST(watermark AS {order_type}) > CAST(? AS {order_type})",
+                     [earliest, table_name, earliest])
+
+
+def keyed_deduplication(conn, table_name, keys, order_column, tie_break=DEDUP_TIE_BREAK):
+    create_dedup_state(conn)
+    column_types = {column[0]: column[1] for column in conn.execute(f"DESCRIBE {table_name}").fetchall()}
+    order_type = column_types[order_column]
+    index_table = f"dedup.index_{table_name}"
+
+    # The key index is only valid for the same key columns and types
+    signature = ','.join(f"{column}:{column_types[column]}" for column in keys + [order_column])
+    state = conn.execute("SELECT key_signature, watermark FROM dedup.state WHERE table_name = ?", [table_name]).fetchone()
+    watermark = None
+    if state is not None and state[0] == signature and state[1] is not None:
+        watermark = state[1]
+    else:
+        reset_dedup_state(conn, table_name)
+
+    key_list = ', '.join(f'"{key}"' for key in keys)
+    not_null = ' AND '.join(f'"{key}" IS NOT NULL' for key in keys)
+    direction = 'DESC' if tie_break == 'latest' else 'ASC'
+
+    # Only the rows from the watermark on are checked, the last snapshot is included again
+    # since rows of the same snapshot can arrive in a later run
+    delta_filter = f'AND "{order_column}" >= CAST(? AS {order_type})' if watermark else ''
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE dedup_delta AS
+    SELECT rowid AS row_id, {key_list}, "{order_column}" AS order_value,
+           row_number() OVER (PARTITION BY {key_list} ORDER BY "{order_column}" {direction}, rowid {direction}) AS position
+    FROM {table_name}
+    WHERE {not_null} {delta_filter};
+    """, [watermark] if watermark else [])
+
+    # Duplicates among the new rows
+    removed = conn.execute(f"DELETE FROM {table_name} WHERE rowid IN (SELECT row_id FROM dedup_delta WHERE position > 1);").fetchone()[0]
+
+    # The key index holds the keys kept so far and the order value of the kept row
+    index_columns = ', '.join(f'"{key}" AS key_{i}' for i, key in enumerate(keys))
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {index_table} AS SELECT {index_columns}, order_value FROM dedup_delta LIMIT 0;")
+    matches_index = ' AND '.join(f'd."{key}" = i.key_{i}' for i, key in enumerate(keys))
+
+    # New rows whose key was kept in a previous run, before the watermark
+    if watermark and tie_break == 'latest':
+        matches_table = ' AND '.join(f'd."{key}" = t."{key}"' for key in keys)
+        removed += conn.execute(f"""
+        DELETE FROM {table_name} t
+        WHERE t."{order_column}" < CAST(? AS {order_type})
+          AND EXISTS (
+            SELECT 1 FROM dedup_delta d JOIN {index_table} i ON {matches_index}
+            WHERE d.position = 1 AND i.order_value < CAST(? AS {order_type}) AND {matches_table});
+        """, [watermark, watermark]).fetchone()[0]
+        conn.execute(f"DELETE FROM {index_table} i WHERE EXISTS (SELECT 1 FROM dedup_delta d WHERE d.position = 1 AND {matches_index});")
+    elif watermark:
+        removed += conn.execute(f"""
+        DELETE FROM {table_name}
+        WHERE rowid IN (
+            SELECT d.row_id FROM dedup_delta d JOIN {index_table} i ON {matches_index}
+            WHERE d.position = 1 AND i.order_value < CAST(? AS {order_type}));
+        """, [watermark]).fetchone()[0]
+
+    # Remember the keys of the new rows and move the watermark
+    conn.execute(f"""
+    INSERT INTO {index_table}
+    SELECT {', '.join(f'd."{key}"' for key in keys)}, d.order_value FROM dedup_delta d
+    WHERE d.position = 1 AND NOT EXISTS (SELECT 1 FROM {index_table} i WHERE {matches_index});
+    """)
+    new_watermark = conn.execute(f'SELECT CAST(MAX("{order_column}") AS VARCHAR) FROM {table_name}').fetchone()[0]
+    conn.execute("INSERT OR REPLACE INTO dedup.state VALUES (?, ?, ?, current_timestamp)", [table_name, signature, new_watermark])
+
+    checked = conn.execute("SELECT COUNT(*) FROM dedup_delta").fetchone()[0]
+    conn.execute("DROP TABLE dedup_delta")
+    return checked, removed
+
+
+def full_deduplication(conn, table_name):
+    # Count rows before deduplication
+    count_before = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
+
+    # Deduplication: Remove duplicate rows
+    conn.execute(f"CREATE TABLE {table_name}_deduplicated AS SELECT DISTINCT * FROM {table_name};")
+    conn.execute(f"DROP TABLE {table_name};")
+    conn.execute(f"ALTER TABLE {table_name}_deduplicated RENAME TO {table_name};")
+
+    # Count rows after deduplication
+    count_after = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
+    return count_before, count_before - count_after
+
+
+def deduplication(db_path, tie_break=DEDUP_TIE_BREAK):
     # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
-    
+    conn = duckdb.connect(db_path, config=get_config())
+
     # Get list of all tables in the database
     tables = conn.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
-    
+
     # Iterate over each table and deduplicate
     for table in tables:
         table_name = table[0]
         print(f"Reading and deduplicating table: {table_name}")
+        # Each table is deduplicated in a transaction, its state never gets ahead of its rows
+        conn.execute("BEGIN TRANSACTION")
         try:
-            # Count rows before deduplication
-            count_before = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-            
-            # Deduplication: Remove duplicate rows
-            conn.execute(f"CREATE TABLE {table_name}_deduplicated AS SELECT DISTINCT * FROM {table_name};")
-            conn.execute(f"DROP TABLE {table_name};")
-            conn.execute(f"ALTER TABLE {table_name}_deduplicated RENAME TO {table_name};")
-            
-            # Count rows after deduplication
-            count_after = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-            
-            # Calculate and inform the number of rows removed
-            rows_removed = count_before - count_after
-            print(f"Deduplicated table '{table_name}': removed {rows_removed} rows.\n")
-            
+            columns = [column[0] for column in conn.execute(f"DESCRIBE {table_name}").fetchall()]
+            keys = [resolve_column(columns, candidates) for candidates in DEDUP_KEYS.get(table_name, [])]
+            order_column = resolve_column(columns, DEDUP_ORDER.get(table_name, ()))
+
+            if keys and None not in keys and order_column:
+                # Deduplication on the business keys, only newly arrived rows are checked
+                checked, rows_removed = keyed_deduplication(conn, table_name, keys, order_column, tie_break)
+                print(f"Deduplicated table '{table_name}' on {keys}: checked {checked} new rows, removed {rows_removed} rows.\n")
+            else:
+                # Tables without business keys: Remove duplicate rows
+                checked, rows_removed = full_deduplication(conn, table_name)
+                print(f"Deduplicated table '{table_name}': removed {rows_removed} rows.\n")
+            conn.execute("COMMIT")
+
         except Exception as e:
+            conn.execute("ROLLBACK")
+            conn.close()
+            # Raised again, a half deduplicated database must not be published
             print(f"Error while deduplicating table '{table_name}': {e}\n")
-    
+            raise
+
     # Close the connection
     conn.close()
 
 def run():
-    deduplication('./trusted_zone/trusted.db')
+    # A later stage of the trusted zone, script3 already kept the previous run as a generation
+    with staged_database('./trusted_zone/trusted.db', rotate=False) as staging:
+        deduplication(staging)
 
 if __name__ == "__main__":
-    deduplication('./trusted_zone/trusted.db')
-
+    run()
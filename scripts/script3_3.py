@@ -1,6 +1,134 @@
 import duckdb
 import pandas as pd
 import numpy as np
+from scripts.batch_runner import run_in_batches, BATCH_SIZE
+from scripts.publishing import staged_database
+from scripts.connections import get_config
+
+# 'sql' formats the tables with a single CREATE OR REPLACE TABLE ... AS SELECT compiled from
+# FORMATTING_RULES, 'pandas' applies the consistent_formatting_* functions batch by batch
+FORMATTING_ENGINE = 'sql'
+
+# Formatting rules per table, column names refer to the names after renaming
+FORMATTING_RULES = {
+    'idealista': {
+        'null_values': ['NULL'],
+        'rename': {},
+        'types': {
+            'propertyCode': 'VARCHAR',
+            'price': 'DOUBLE',
+            'size': 'DOUBLE',
+            'latitude': 'DOUBLE',
+            'longitude': 'DOUBLE',
+            'priceByArea': 'DOUBLE',
+            'timestamp': 'TIMESTAMP',
+        },
+        # Integer columns where missing values become 0
+        'counts': ['rooms', 'bathrooms'],
+        # Boolean columns where missing values become False, as astype(bool) does in the pandas engine
+        'booleans': ['exterior', 'hasLift', 'newDevelopment'],
+        # Stripped and lowercased, missing values become 'unknown'
+        'categorical': ['propertyType', 'operation', 'address', 'province', 'municipality',
+                        'district', 'country', 'neighborhood', 'status', 'floor'],
+        'value_maps': {
+            'floor': {'bj': 'bajo', 'ss': 'sotano', 'en': 'entresuelo'},
+        },
+        'dates': {},
+    },
+    'income': {
+        'null_values': ['NULL'],
+        'rename': {
+            'Distric': 'district',
+            'Barris': 'neighborhood',
+            'RDLpc (€)': 'rdlpc_eur',
+            'Index (RDLpc)': 'index_rdlpc',
+            'RPLpc (€)': 'rplpc_eur',
+            'Index (RPLpc)': 'index_rplpc',
+            'timestamp': 'year',
+        },
+        'types': {
+            'rdlpc_eur': 'DOUBLE',
+            'rplpc_eur': 'DOUBLE',
+            'index_rdlpc': 'DOUBLE',
+            'index_rplpc': 'DOUBLE',
+        },
+        'counts': [],
+        'booleans': [],
+        'categorical': ['district', 'neighborhood'],
+        'value_maps': {},
+        # Parsed with strptime formats
+        'dates': {'year': '%Y'},
+    },
+}
+
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def compile_formatting_query(columns, table_name, rules):
+    expressions = []
+    for name, data_type in columns:
+        target = rules['rename'].get(name, name)
+        expression = f'"{name}"'
+
+        # Standardize null values
+        if data_type == 'VARCHAR' and rules['null_values']:
+            expression = f"CASE WHEN {expression} IN ({', '.join(quote_literal(value) for value in rules['null_values'])}) THEN NULL ELSE {expression} END"
+
+        # Normalize data types
+        if target in rules['types']:
+            expression = f"TRY_CAST({expression} AS {rules['types'][target]})"
+        elif target in rules['counts']:
+            expression = f"COALESCE(TRY_CAST({expression} AS INTEGER), 0)"
+        elif target in rules['booleans']:
+            expression = f"COALESCE(TRY_CAST({expression} AS BOOLEAN), FALSE)"
+        elif target in rules['dates'] and data_type not in ('DATE', 'TIMESTAMP'):
+            # Already parsed columns are kept, formatting a formatted table changes nothing
+            expression = f"TRY_STRPTIME(CAST({expression} AS VARCHAR), {quote_literal(rules['dates'][target])})"
+        elif target in rules['categorical']:
+            expression = f"COALESCE(lower(trim(CAST({expression} AS VARCHAR))), 'unknown')"
+            # Standardize values (e.g., 'bj' to 'bajo')
+            value_map = rules['value_maps'].get(target)
+            if value_map:
+                cases = ' '.join(f"WHEN {quote_literal(old)} THEN {quote_literal(new)}" for old, new in value_map.items())
+                expression = f"CASE {expression} {cases} ELSE {expression} END"
+
+        expressions.append(f'{expression} AS "{target}"')
+    return f"SELECT {', '.join(expressions)} FROM {table_name}"
+
+
+def get_target_types(target, rules):
+    # Types a column can have after formatting, None when the rules do not change its type
+    if target in rules['types']:
+        return (rules['types'][target],)
+    if target in rules['counts']:
+        return ('INTEGER',)
+    if target in rules['booleans']:
+        return ('BOOLEAN',)
+    if target in rules['dates']:
+        return ('DATE', 'TIMESTAMP')
+    if target in rules['categorical']:
+        return ('VARCHAR',)
+    return None
+
+
+def is_formatted(columns, rules):
+    # Tables merged by script3 are formatted as their rows arrive, their columns already have the target names and types
+    for name, data_type in columns:
+        if rules['rename'].get(name, name) != name:
+            return False
+        target_types = get_target_types(name, rules)
+        if target_types and data_type not in target_types:
+            return False
+    return True
+
+
+def get_formatting_query(conn, query, table_name):
+    # The rules of table_name applied to the rows of a query
+    columns = [column[:2] for column in conn.execute(f"DESCRIBE {query}").fetchall()]
+    return compile_formatting_query(columns, f"({query})", FORMATTING_RULES[table_name])
+
 
 
 def consistent_formatting_idealista(df):
@@ -43,43 +171,6 @@ def consistent_formatting_idealista(df):
 
 
 
-def consistent_formatting_idealista_script(db_path, table_name='idealista'):
-
-    try:
-        # Connect to the DuckDB database
-        con = duckdb.connect(db_path)
-        print(f"Connected to DuckDB database at '{db_path}'.")
-        
-        # Check if the table exists
-        tables = con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
-        existing_tables = [table[0] for table in tables]
-        
-        if table_name not in existing_tables:
-            print(f"Error: Table '{table_name}' does not exist in the database.")
-            con.close()
-            return
-        
-        print(f"Processing table: '{table_name}'.")
-        
-        # Read the table into a DataFrame and Apply consistent formatting
-        df = con.execute(f"SELECT * FROM {table_name}").fetchdf() 
-        formatted_df = consistent_formatting_idealista(df)
-        
-        # Overwrite the original table with the formatted DataFrame
-        con.execute(f"DROP TABLE IF EXISTS {table_name}")
-        con.register('formatted_df', formatted_df)
-        con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM formatted_df")
-        print(f"Table '{table_name}' has been overwritten with formatted data.")
-        
-        # Close the connection
-        con.close()
-    
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-
-
-
-
 def consistent_formatting_income(df):
     # Standardize null values
     df = df.replace('NULL', np.nan)
@@ -113,11 +204,11 @@ def consistent_formatting_income(df):
     
     return df
 
-def consistent_formatting_income_script(db_path, table_name='income'):
+def consistent_formatting_script(db_path, table_name, transform, engine=FORMATTING_ENGINE, batch_size=BATCH_SIZE):
 
     try:
         # Connect to the DuckDB database
-        con = duckdb.connect(db_path)
+        con = duckdb.connect(db_path, config=get_config())
         print(f"Connected to DuckDB database at '{db_path}'.")
         
         # Check if the table exists
@@ -130,28 +221,45 @@ def consistent_formatting_income_script(db_path, table_name='income'):
             return
         
         print(f"Processing table: '{table_name}'.")
-        
-        # Read the table into a DataFrame and Apply consistent formatting
-        df = con.execute(f"SELECT * FROM {table_name}").fetchdf() 
-        formatted_df = consistent_formatting_income(df)
-        
-        # Overwrite the original table with the formatted DataFrame
-        con.execute(f"DROP TABLE IF EXISTS {table_name}")
-        con.register('formatted_df', formatted_df)
-        con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM formatted_df")
+
+        columns = [column[:2] for column in con.execute(f"DESCRIBE {table_name}").fetchall()]
+        if is_formatted(columns, FORMATTING_RULES[table_name]):
+            # Nothing to change, the table is not rewritten
+            print(f"Table '{table_name}' is already formatted.")
+            con.close()
+            return
+
+        if engine == 'sql':
+            # The rules run inside DuckDB, the table never goes through pandas
+            query = compile_formatting_query(columns, table_name, FORMATTING_RULES[table_name])
+            con.execute(f"CREATE OR REPLACE TABLE {table_name} AS {query}")
+        else:
+            # Apply consistent formatting batch by batch, only one batch is held in memory
+            run_in_batches(con, table_name, table_name, transform, batch_size)
         print(f"Table '{table_name}' has been overwritten with formatted data.")
         
         # Close the connection
         con.close()
     
     except Exception as e:
+        # Raised again, a half formatted database must not be published
         print(f"An unexpected error occurred: {e}")
+        raise
+
+
+def consistent_formatting_idealista_script(db_path, table_name='idealista', engine=FORMATTING_ENGINE, batch_size=BATCH_SIZE):
+    consistent_formatting_script(db_path, table_name, consistent_formatting_idealista, engine, batch_size)
+
+
+def consistent_formatting_income_script(db_path, table_name='income', engine=FORMATTING_ENGINE, batch_size=BATCH_SIZE):
+    consistent_formatting_script(db_path, table_name, consistent_formatting_income, engine, batch_size)
 
 
 def run():
-    consistent_formatting_idealista_script('./trusted_zone/trusted.db', table_name='idealista')
-    consistent_formatting_income_script('./trusted_zone/trusted.db', 'income')
+    # A later stage of the trusted zone, script3 already kept the previous run as a generation
+    with staged_database('./trusted_zone/trusted.db', rotate=False) as staging:
+        consistent_formatting_idealista_script(staging, table_name='idealista')
+        consistent_formatting_income_script(staging, 'income')
 
 if __name__ == "__main__":
-    consistent_formatting_idealista_script('./trusted_zone/trusted.db', table_name='idealista')
-    consistent_formatting_income_script('./trusted_zone/trusted.db', 'income')
+    run()
@@ -1,79 +1,176 @@
-import duckdb
 import pandas as pd
 import os
 
+from scripts.quantile_sketch import update_sketches, create_iqr_bounds
+from scripts.publishing import staged_database
+from scripts.connections import get_connection
 
-def remove_idealista_outliers(db_path):
-    # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
-    
-    table_name = "idealista"
+# Outlier rules per table, evaluated in order. A rejected row is tagged with the first rule that fires,
+# NULL values only fire 'not_null' rules.
+#   max:      values above 'value'
+#   allowed:  values not in 'values'
+#   excluded: values in 'values'
+#   not_null: missing values
+#   iqr:      values outside [Q1 - k * IQR, Q3 + k * IQR] of the column
+#   robust:   values outside [Q1 - k * IQR, Q3 + k * IQR] of their neighborhood and month,
+#             read from quantile sketches that are updated with the new rows only
+OUTLIER_RULES = {
+    'idealista': [
+        {'name': 'size_above_1000', 'column': 'size', 'type': 'max', 'value': 1000},
+        {'name': 'price_above_5000000', 'column': 'price', 'type': 'max', 'value': 5000000},
+        {'name': 'operation_rent', 'column': 'operation', 'type': 'excluded', 'values': ['rent']},
+        {'name': 'province_not_barcelona', 'column': 'province', 'type': 'allowed', 'values': ['barcelona']},
+        {'name': 'municipality_not_barcelona', 'column': 'municipality', 'type': 'allowed', 'values': ['barcelona']},
+        {'name': 'country_not_spain', 'column': 'country', 'type': 'allowed', 'values': ['es']},
+        {'name': 'price_robust', 'column': 'price', 'type': 'robust', 'k': 3},
+        {'name': 'size_robust', 'column': 'size', 'type': 'robust', 'k': 3},
+        {'name': 'price_by_area_robust', 'column': 'priceByArea', 'type': 'robust', 'k': 3},
+    ],
+    'income': [
+        {'name': 'district_missing', 'column': 'district', 'type': 'not_null'},
+    ],
+}
 
-    try:
-        # Count initial number of records
-        initial_count = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-        
-        # Remove records with size larger than 1000 m²
-        conn.execute(f"DELETE FROM {table_name} WHERE size > 1000;")
-        
-        # Remove records with price higher than 5,000,000
-        conn.execute(f"DELETE FROM {table_name} WHERE price > 5000000;")
-        
-        # Remove records with operation type 'rent'
-        conn.execute(f"DELETE FROM {table_name} WHERE operation = 'rent';")
-        
-        # Remove records where province is not 'Barcelona'
-        conn.execute(f"DELETE FROM {table_name} WHERE province != 'barcelona';")
-        
-        # Remove records with municipality 'other'
-        conn.execute(f"DELETE FROM {table_name} WHERE municipality != 'barcelona';")
-
-        # Remove records where country is not 'Spain'
-        conn.execute(f"DELETE FROM {table_name} WHERE country != 'es';")
-        
-        # Count final number of records
-        final_count = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-        
-        # Calculate the number of outliers removed
-        removed_outliers = initial_count - final_count
-        print(f"Number of outliers removed: {removed_outliers}")
-        
-    except Exception as e:
-        print(f"Error while removing outliers from table '{table_name}': {e}")
-    
-    # Close the connection
-    conn.close()
+# Grouping of the robust rules
+ROBUST_GROUP_COLUMN = 'neighborhood'
+ROBUST_TIME_COLUMN = 'timestamp'
 
+# Rejected rows are kept in this schema, in a table named after the source table
+QUARANTINE_SCHEMA = 'quarantine'
 
-def remove_income_outliers(db_path):
-    # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
-    
-    table_name = "income"
 
+def quote_value(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def get_rule_condition(rule, position):
+    column = f'"{rule["column"]}"'
+    if rule['type'] == 'max':
+        return f"{column} > {quote_value(rule['value'])}"
+    if rule['type'] == 'allowed':
+        return f"{column} NOT IN ({', '.join(quote_value(value) for value in rule['values'])})"
+    if rule['type'] == 'excluded':
+        return f"{column} IN ({', '.join(quote_value(value) for value in rule['values'])})"
+    if rule['type'] == 'not_null':
+        return f"{column} IS NULL"
+    if rule['type'] == 'iqr':
+        return f"({column} < bounds.lower_{position} OR {column} > bounds.upper_{position})"
+    if rule['type'] == 'robust':
+        return f'({column} < robust_bounds."lower_{rule["column"]}" OR {column} > robust_bounds."upper_{rule["column"]}")'
+    raise ValueError(f"Unknown outlier rule type: {rule['type']}")
+
+
+def get_bounds_query(table_name, rules):
+    # All quantile bounds are computed by one aggregate over the table
+    bounds = []
+    for position, rule in enumerate(rules):
+        if rule['type'] == 'iqr':
+            column = f'"{rule["column"]}"'
+            k = rule.get('k', 1.5)
+            q1, q3 = f"quantile_cont({column}, 0.25)", f"quantile_cont({column}, 0.75)"
+            bounds.append(f"{q1} - {k} * ({q3} - {q1}) AS lower_{position}")
+            bounds.append(f"{q3} + {k} * ({q3} - {q1}) AS upper_{position}")
+    if not bounds:
+        return None
+    return f"SELECT {', '.join(bounds)} FROM {table_name}"
+
+
+def tag_outliers(conn, table_name, rules):
+    # Runs in the caller's transaction, returns the rejections per rule and the rules that applied
+    columns = [column[0] for column in conn.execute(f"DESCRIBE {table_name}").fetchall()]
+
+    # Rules on columns the table does not have are skipped
+    rules = [rule for rule in rules if rule['column'] in columns]
+    if ROBUST_GROUP_COLUMN not in columns or ROBUST_TIME_COLUMN not in columns:
+        rules = [rule for rule in rules if rule['type'] != 'robust']
+    robust_rules = [rule for rule in rules if rule['type'] == 'robust']
+    if not rules:
+        return {}, rules
+
+    # Every row is tagged with the first rule that fires in a single scan
+    cases = '\n'.join(f"WHEN {get_rule_condition(rule, position)} THEN {quote_value(rule['name'])}" for position, rule in enumerate(rules))
+    bounds_query = get_bounds_query(table_name, rules)
+    source = f"{table_name} CROSS JOIN ({bounds_query}) AS bounds" if bounds_query else table_name
+    if robust_rules:
+        month = f"CAST(date_trunc('month', CAST({table_name}.\"{ROBUST_TIME_COLUMN}\" AS DATE)) AS DATE)"
+        source += f"""
+        LEFT JOIN robust_bounds ON robust_bounds.group_key = CAST({table_name}."{ROBUST_GROUP_COLUMN}" AS VARCHAR)
+                               AND robust_bounds.month = {month}"""
+    column_list = ', '.join(f'{table_name}."{column}"' for column in columns)
+
+    if robust_rules:
+        # The sketches only take the new rows that pass the fixed rules
+        fixed_cases = ' '.join(f"WHEN {get_rule_condition(rule, position)} THEN 1" for position, rule in enumerate(rules) if rule['type'] not in ('iqr', 'robust'))
+        passes_fixed_rules = f"CASE {fixed_cases} END IS NULL" if fixed_cases else None
+        # Rows quarantined by the robust rules were counted before they were removed
+        removed = None
+        if conn.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = ?", [QUARANTINE_SCHEMA, table_name]).fetchone()[0]:
+            robust_names = ', '.join(quote_value(rule['name']) for rule in robust_rules)
+            removed = f"(SELECT * FROM {QUARANTINE_SCHEMA}.{table_name} WHERE outlier_rule IN ({robust_names}))"
+        update_sketches(conn, table_name, [rule['column'] for rule in robust_rules], ROBUST_GROUP_COLUMN, ROBUST_TIME_COLUMN, passes_fixed_rules, removed)
+        create_iqr_bounds(conn, table_name, {rule['column']: rule.get('k', 3) for rule in robust_rules})
+
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE outlier_tagged AS
+    SELECT {column_list}, CASE {cases} END AS outlier_rule
+    FROM {source};
+    """)
+
+    # Kept rows replace the table, rejected rows are appended to the quarantine with the rule that fired
+    conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * EXCLUDE (outlier_rule) FROM outlier_tagged WHERE outlier_rule IS NULL;")
+    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {QUARANTINE_SCHEMA};")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {QUARANTINE_SCHEMA}.{table_name} AS SELECT *, current_timestamp AS quarantined_at FROM outlier_tagged LIMIT 0;")
+    conn.execute(f"INSERT INTO {QUARANTINE_SCHEMA}.{table_name} BY NAME SELECT *, current_timestamp AS quarantined_at FROM outlier_tagged WHERE outlier_rule IS NOT NULL;")
+
+    # Rejections per rule, rules that did not fire are reported with 0
+    counts = dict(conn.execute("SELECT outlier_rule, COUNT(*) FROM outlier_tagged WHERE outlier_rule IS NOT NULL GROUP BY outlier_rule").fetchall())
+    conn.execute("DROP TABLE outlier_tagged")
+    conn.execute("DROP TABLE IF EXISTS robust_bounds")
+    return counts, rules
+
+
+def remove_outliers(db_path, table_name, rules=None):
+    rules = OUTLIER_RULES.get(table_name, []) if rules is None else rules
+
+    # Connect to the DuckDB database
+    conn = get_connection(db_path)
     try:
-        # Count initial number of records
-        initial_count = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-
-        conn.execute(f"DELETE FROM {table_name} WHERE district IS NULL;")
-        
-        # Count final number of records
-        final_count = conn.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-        
-        # Calculate the number of outliers removed
-        removed_outliers = initial_count - final_count
-        print(f"Number of outliers removed: {removed_outliers}")
-        
+        conn.execute("BEGIN TRANSACTION")
+        counts, rules = tag_outliers(conn, table_name, rules)
+        conn.execute("COMMIT")
     except Exception as e:
+        conn.execute("ROLLBACK")
+        conn.close()
+        # Raised again, a half filtered database must not be published
         print(f"Error while removing outliers from table '{table_name}': {e}")
-    
+        raise
+
     # Close the connection
     conn.close()
+    return {rule['name']: counts.get(rule['name'], 0) for rule in rules}
+
+
+def reset_quarantine(conn, table_name):
+    # Called when a table is rebuilt, its rows go through the rules again
+    conn.execute(f"DROP TABLE IF EXISTS {QUARANTINE_SCHEMA}.{table_name}")
+
+
+def remove_idealista_outliers(db_path):
+    return remove_outliers(db_path, "idealista")
+
+
+def remove_income_outliers(db_path):
+    return remove_outliers(db_path, "income")
 
 def run():
-    remove_idealista_outliers('./trusted_zone/trusted.db')
-    remove_income_outliers('./trusted_zone/trusted.db')
+    # A later stage of the trusted zone, script3 already kept the previous run as a generation
+    with staged_database('./trusted_zone/trusted.db', rotate=False) as staging:
+        return {
+            'idealista': remove_idealista_outliers(staging),
+            'income': remove_income_outliers(staging),
+        }
 
 if __name__ == "__main__":
-    remove_idealista_outliers('./trusted_zone/trusted.db')
-    remove_income_outliers('./trusted_zone/trusted.db')
+    print(run())
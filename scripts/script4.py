@@ -1,19 +1,33 @@
 import duckdb
 import os
 
+from scripts.publishing import staged_database
+from scripts.connections import get_config
+from scripts.script4_2 import refresh_kpis
+
 
 SOURCE_DB = './trusted_zone/trusted.db'
 DESTINATION_FOLDER = './exploitation_zone/'
 
 DESTINATION_DB = os.path.join(DESTINATION_FOLDER, 'exploitation.db')
 
-def create_connections(source, destination):
-    # Connect to the existing trusted.db
-    trusted_con = duckdb.connect(database=source)
+# Tables in drop order, 'house' references 'idealista'
+TABLES = ['house', 'idealista', 'income', 'neighborhood']
+
+# 'full' rebuilds every table, 'incremental' upserts the listings of the trusted sources not loaded yet
+# and the listings from the latest loaded timestamp on
+LOAD_MODE = 'incremental'
 
+# Sources of the trusted idealista table already loaded, a copy of its merge ledger (script3)
+LOADED_SCHEMA = 'loaded'
+
+def create_connections(source, destination):
     # Connect to the new exploitation.db
-    exploitation_con = duckdb.connect(database=destination)
-    return trusted_con, exploitation_con
+    exploitation_con = duckdb.connect(database=destination, config=get_config())
+
+    # The trusted zone is attached read only, rows are copied inside DuckDB
+    exploitation_con.execute(f"ATTACH '{source}' AS trusted (READ_ONLY)")
+    return exploitation_con
 
 def drop_tables(tables, exploitation_con):
 # Drop existing tables to ensure a clean slate
@@ -22,7 +36,20 @@ def drop_tables(tables, exploitation_con):
         drop_query = f"DROP TABLE IF EXISTS {table};"
         exploitation_con.execute(drop_query)
 
-def create_neighborhood_table(trusted_con, exploitation_con):
+def update_set(columns):
+    # Non-key columns of a row that already exists are overwritten by the new row
+    return ', '.join(f"{column} = EXCLUDED.{column}" for column in columns)
+
+def load_neighborhood(exploitation_con):
+    exploitation_con.execute("""
+    INSERT INTO neighborhood (district, neighborhood)
+    SELECT DISTINCT district, neighborhood
+    FROM trusted.income
+    WHERE district IS NOT NULL AND neighborhood IS NOT NULL
+    ON CONFLICT DO NOTHING
+    """)
+
+def create_neighborhood_table(exploitation_con):
     exploitation_con.execute("""
     CREATE OR REPLACE TABLE neighborhood (
         district VARCHAR,
@@ -31,20 +58,20 @@ def create_neighborhood_table(trusted_con, exploitation_con):
     );
     """)
 
-    NEIGHBORHOOD_data = trusted_con.execute("""
-    SELECT DISTINCT district, neighborhood
-    FROM income
-    """).fetchall()
-
-    filtered_list = [tup for tup in NEIGHBORHOOD_data if None not in tup]
-
+    load_neighborhood(exploitation_con)
 
-    exploitation_con.executemany("""
-    INSERT INTO neighborhood (district, neighborhood) VALUES (?, ?)
-    ON CONFLICT DO NOTHING
-    """, filtered_list)
+def load_income(exploitation_con):
+    # The first row of a (neighborhood, year) is kept
+    exploitation_con.execute(f"""
+    INSERT INTO income (neighborhood, rdlpc_eur, year)
+    SELECT neighborhood, rdlpc_eur, year
+    FROM trusted.income
+    WHERE neighborhood IS NOT NULL AND year IS NOT NULL
+    QUALIFY row_number() OVER (PARTITION BY neighborhood, year ORDER BY rowid) = 1
+    ON CONFLICT DO UPDATE SET {update_set(['rdlpc_eur'])}
+    """)
 
-def create_income_table(trusted_con, exploitation_con):
+def create_income_table(exploitation_con):
     exploitation_con.execute("""
     CREATE OR REPLACE TABLE income (
         neighborhood VARCHAR,
@@ -54,17 +81,35 @@ def create_income_table(trusted_con, exploitation_con):
     );
     """)
 
-    income_data = trusted_con.execute("""
-    SELECT neighborhood, rdlpc_eur, year
-    FROM income
-    """).fetchall()
-
-    exploitation_con.executemany("""
-    INSERT INTO income (neighborhood, rdlpc_eur, year) VALUES (?, ?, ?)
-    ON CONFLICT DO NOTHING
-    """, income_data)
+    load_income(exploitation_con)
+
+def get_range_filter(ranges):
+    # ranges are (earliest, latest) timestamps, an open range has no latest
+    if ranges is None:
+        return "", []
+    conditions, parameters = [], []
+    for earliest, latest in ranges:
+        if latest is None:
+            conditions.append("timestamp >= ?")
+            parameters.append(earliest)
+        else:
+            conditions.append("timestamp BETWEEN ? AND ?")
+            parameters += [earliest, latest]
+    return f"AND ({' OR '.join(conditions)})", parameters
+
+def load_idealista(exploitation_con, ranges=None):
+    # Only rows in the ranges to load, the last row of a (propertyCode, timestamp) is kept
+    since, parameters = get_range_filter(ranges)
+    exploitation_con.execute(f"""
+    INSERT INTO idealista (propertyCode, price, neighborhood, timestamp)
+    SELECT propertyCode, price, neighborhood, timestamp
+    FROM trusted.idealista
+    WHERE propertyCode IS NOT NULL AND timestamp IS NOT NULL {since}
+    QUALIFY row_number() OVER (PARTITION BY propertyCode, timestamp ORDER BY rowid DESC) = 1
+    ON CONFLICT DO UPDATE SET {update_set(['price', 'neighborhood'])}
+    """, parameters)
 
-def create_idealista_table(trusted_con, exploitation_con):
+def create_idealista_table(exploitation_con):
     exploitation_con.execute("""
     CREATE OR REPLACE TABLE idealista (
         propertyCode VARCHAR,
@@ -75,18 +120,28 @@ def create_idealista_table(trusted_con, exploitation_con):
     );
     """)
 
-    idealista_data = trusted_con.execute("""
-    SELECT propertyCode, price, neighborhood, timestamp
-    FROM idealista
-    """).fetchall()
-
-    unique_data = list({(row[0], row[3]): row for row in idealista_data}.values())
-
-    exploitation_con.executemany("""
-    INSERT INTO idealista (propertyCode, price, neighborhood, timestamp) VALUES (?, ?, ?, ?)
-    """, unique_data)
-
-def create_house_table(trusted_con, exploitation_con):
+    load_idealista(exploitation_con)
+
+HOUSE_COLUMNS = [
+    'floor', 'propertyType', 'size', 'status', 'newDevelopment', 'hasLift', 'rooms',
+    'bathrooms', 'exterior', 'latitude', 'longitude', 'address', 'province', 'municipality',
+    'district', 'country', 'neighborhood', 'priceByArea'
+]
+
+def load_house(exploitation_con, ranges=None):
+    # Populate 'house' table, the last row of a (propertyCode, timestamp) is kept like in 'idealista'
+    since, parameters = get_range_filter(ranges)
+    columns = ', '.join(['propertyCode'] + HOUSE_COLUMNS + ['timestamp'])
+    exploitation_con.execute(f"""
+    INSERT INTO house ({columns})
+    SELECT {columns}
+    FROM trusted.idealista
+    WHERE propertyCode IS NOT NULL AND timestamp IS NOT NULL {since}
+    QUALIFY row_number() OVER (PARTITION BY propertyCode, timestamp ORDER BY rowid DESC) = 1
+    ON CONFLICT DO UPDATE SET {update_set(HOUSE_COLUMNS)}
+    """, parameters)
+
+def create_house_table(exploitation_con):
     exploitation_con.execute("""
     CREATE OR REPLACE TABLE house (
         propertyCode VARCHAR,
@@ -114,80 +169,138 @@ def create_house_table(trusted_con, exploitation_con):
     );
     """)
 
-    # Populate 'house' table
-    house_data = trusted_con.execute("""
-    SELECT 
-        propertyCode,
-        floor,
-        propertyType,
-        size,
-        status,
-        newDevelopment,
-        hasLift,
-        rooms,
-        bathrooms,
-        exterior,
-        latitude,
-        longitude,
-        address,
-        province,
-        municipality,
-        district,
-        country,
-        neighborhood,
-        priceByArea,
-        timestamp
-    FROM idealista
-    """).fetchall()
-
-    unique_data = list({(row[0], row[19]): row for row in house_data}.values())
-
-    exploitation_con.executemany("""
-    INSERT INTO house (
-        propertyCode, floor, propertyType, size, status, newDevelopment, hasLift, rooms, 
-        bathrooms, exterior, latitude, longitude, address, province, municipality, 
-        district, country, neighborhood, priceByArea, timestamp
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, unique_data)
-
-def create_all_tables(trusted_con, exploitation_con):
-    create_neighborhood_table(trusted_con, exploitation_con)
-    create_income_table(trusted_con, exploitation_con)
-    create_idealista_table(trusted_con, exploitation_con)
-    create_house_table(trusted_con, exploitation_con)
-
-def close_connections(trusted_con, exploitation_con):
-    # Connect to the existing trusted.db
-    trusted_con.close()
+    load_house(exploitation_con)
+
+def create_all_tables(exploitation_con):
+    create_neighborhood_table(exploitation_con)
+    create_income_table(exploitation_con)
+    create_idealista_table(exploitation_con)
+    create_house_table(exploitation_con)
+
+def has_merge_ledger(exploitation_con):
+    return exploitation_con.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_catalog = 'trusted' AND table_schema = 'merged' AND table_name = 'sources' AND column_name = 'earliest_timestamp';
+        """).fetchone()[0] > 0
+
+def create_loaded_sources(exploitation_con):
+    exploitation_con.execute(f"CREATE SCHEMA IF NOT EXISTS {LOADED_SCHEMA};")
+    exploitation_con.execute(f"""
+    CREATE TABLE IF NOT EXISTS {LOADED_SCHEMA}.sources (
+        source_table VARCHAR,
+        source_file VARCHAR,
+        content_hash VARCHAR,
+        merged_at TIMESTAMP
+    );
+    """)
 
-    # Connect to the new exploitation.db
+def record_loaded_sources(exploitation_con):
+    # Called after every load, the sources of the next load are the ones merged since
+    if not has_merge_ledger(exploitation_con):
+        return
+    create_loaded_sources(exploitation_con)
+    exploitation_con.execute(f"DELETE FROM {LOADED_SCHEMA}.sources")
+    exploitation_con.execute(f"""
+    INSERT INTO {LOADED_SCHEMA}.sources
+    SELECT source_table, source_file, content_hash, merged_at FROM trusted.merged.sources WHERE table_name = 'idealista'
+    """)
+
+def get_load_ranges(exploitation_con):
+    # Time ranges of the trusted listings to load, None when the tables have to be built
+    tables = [table[0] for table in exploitation_con.execute("SELECT table_name FROM information_schema.tables WHERE table_catalog = current_database() AND table_schema = 'main';").fetchall()]
+    if not all(table in tables for table in TABLES):
+        return None
+    high_water_mark = exploitation_con.execute("SELECT MAX(timestamp) FROM idealista").fetchone()[0]
+    if high_water_mark is None:
+        return None
+
+    # The last loaded timestamp is loaded again, listings of that snapshot can arrive late
+    ranges = [(high_water_mark, None)]
+    if not has_merge_ledger(exploitation_con):
+        return ranges
+
+    # Loaded sources missing from the ledger: the trusted table was rebuilt, e.g. a source changed
+    create_loaded_sources(exploitation_con)
+    loaded, stale = exploitation_con.execute(f"""
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE m.source_table IS NULL)
+        FROM {LOADED_SCHEMA}.sources l
+        LEFT JOIN (SELECT * FROM trusted.merged.sources WHERE table_name = 'idealista') m
+          ON m.source_table = l.source_table AND m.source_file = l.source_file
+         AND m.content_hash IS NOT DISTINCT FROM l.content_hash AND m.merged_at = l.merged_at
+        """).fetchone()
+    if not loaded or stale:
+        return None
+
+    # Sources merged since the last load, backfilled snapshots older than the high-water mark included
+    new_sources = exploitation_con.execute(f"""
+        SELECT m.earliest_timestamp, m.latest_timestamp FROM trusted.merged.sources m
+        WHERE m.table_name = 'idealista' AND NOT EXISTS (
+            SELECT 1 FROM {LOADED_SCHEMA}.sources l
+            WHERE l.source_table = m.source_table AND l.source_file = m.source_file AND l.merged_at = m.merged_at)
+        """).fetchall()
+    for earliest, latest in new_sources:
+        if earliest is None:
+            # Merged by a rebuild, its rows are not known
+            return None
+        ranges.append((earliest, latest))
+    return ranges
+
+def get_loaded_months(exploitation_con, ranges):
+    # Months of the listings upserted by the load, their KPIs are computed again
+    since, parameters = get_range_filter(ranges)
+    months = exploitation_con.execute(f"""
+    SELECT DISTINCT CAST(date_trunc('month', timestamp) AS DATE) FROM trusted.idealista
+    WHERE propertyCode IS NOT NULL AND timestamp IS NOT NULL {since}
+    """, parameters).fetchall()
+    return [month[0] for month in months]
+
+def update_all_tables(exploitation_con, ranges):
+    load_neighborhood(exploitation_con)
+    load_income(exploitation_con)
+    load_idealista(exploitation_con, ranges)
+    load_house(exploitation_con, ranges)
+
+def load_tables(exploitation_con, mode=LOAD_MODE):
+    # A single transaction, readers see either the previous or the new tables
+    exploitation_con.execute("BEGIN TRANSACTION")
+    try:
+        ranges = get_load_ranges(exploitation_con) if mode == 'incremental' else None
+        if ranges is None:
+            drop_tables(TABLES, exploitation_con)
+            create_all_tables(exploitation_con)
+        else:
+            update_all_tables(exploitation_con, ranges)
+        record_loaded_sources(exploitation_con)
+        # The KPIs are kept in step with the tables they are computed from
+        refresh_kpis(exploitation_con, get_loaded_months(exploitation_con, ranges) if ranges is not None else None)
+        exploitation_con.execute("COMMIT")
+    except Exception:
+        exploitation_con.execute("ROLLBACK")
+        raise
+    return ranges
+
+def close_connections(exploitation_con):
+    # Detach the trusted.db and close the exploitation.db
+    exploitation_con.execute("DETACH trusted")
     exploitation_con.close()
 
-def run():
+def run(mode=LOAD_MODE):
     if not os.path.exists(SOURCE_DB):
         return (f"File not found: {SOURCE_DB}")
 
     os.makedirs(DESTINATION_FOLDER, exist_ok=True)
 
-    trusted_con, exploitation_con = create_connections(SOURCE_DB, DESTINATION_DB)
-
-    tables_to_drop = ['house', 'idealista', 'income', 'neighborhood']
-    drop_tables(tables_to_drop, exploitation_con)
-
-    create_all_tables(trusted_con, exploitation_con)
+    # Built on a staging copy, readers keep the last good database until it is swapped in
+    with staged_database(DESTINATION_DB) as staging:
+        exploitation_con = create_connections(SOURCE_DB, staging)
+        try:
+            ranges = load_tables(exploitation_con, mode)
+        finally:
+            close_connections(exploitation_con)
 
-    close_connections(trusted_con, exploitation_con)
+    if ranges is None:
+        return "Exploitation tables rebuilt"
+    return f"Exploitation tables updated from {min(earliest for earliest, _ in ranges)}"
 
 if __name__ == "__main__":
-    if not os.path.exists(SOURCE_DB):
-        exit 
-    os.makedirs(DESTINATION_FOLDER, exist_ok=True)
-
-    trusted_con, exploitation_con = create_connections(SOURCE_DB, DESTINATION_DB)
-
-    tables_to_drop = ['house', 'idealista', 'income', 'neighborhood']
-    drop_tables(tables_to_drop, exploitation_con)
-
-    create_all_tables(trusted_con, exploitation_con)
-
-    close_connections(trusted_con, exploitation_con)
\ No newline at end of file
+    run()
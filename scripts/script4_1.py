@@ -1,4 +1,4 @@
-import duckdb
+from scripts.connections import get_connection
 import pandas as pd
 import numpy as np
 import os
@@ -12,7 +12,7 @@ def data_profiling(db_path, output_dir):
         os.makedirs(output_dir)
     
     # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
+    conn = get_connection(db_path, read_only=True)
     
     # Get list of all tables in the database
     tables = conn.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
@@ -41,7 +41,7 @@ def profile_database(db_path, output_path):
         os.makedirs(output_path)
     
     # Connect to the DuckDB database
-    conn = duckdb.connect(db_path)
+    conn = get_connection(db_path, read_only=True)
     
     # Get list of all tables in the database
     tables = conn.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
@@ -1,150 +1,210 @@
-import duckdb
+from scripts.connections import get_connection
+from scripts.quantile_sketch import bucket_expression, quantiles_query
 
 EXPLOITATION_DB = './exploitation_zone/exploitation.db'
 
+# Materialized KPIs are kept in this schema of the exploitation database as mergeable aggregates
+# (sums and counts for averages, quantile sketches for medians), the KPIs are read by summing them
+KPI_SCHEMA = 'kpi'
+
+MONTH = "CAST(date_trunc('month', timestamp) AS DATE)"
+
+# Aggregates per source table, {since} selects the rows of the months being refreshed
+KPI_AGGREGATES = {
+    'idealista': {
+        'idealista_price': f"""
+            SELECT neighborhood, {MONTH} AS month, SUM(price) AS price_sum, COUNT(price) AS price_count
+            FROM idealista WHERE {{since}}
+            GROUP BY ALL
+        """,
+        'idealista_price_sketch': f"""
+            SELECT neighborhood AS group_key, {MONTH} AS month, 'price' AS metric, {bucket_expression('price')} AS bucket, COUNT(*) AS count
+            FROM idealista WHERE price > 0 AND {{since}}
+            GROUP BY ALL
+        """,
+    },
+    'house': {
+        'house_month': f"""
+            SELECT {MONTH} AS month,
+                   SUM(TRY_CAST(floor AS DOUBLE)) FILTER (WHERE floor ~ '^[0-9]+$') AS floor_sum,
+                   COUNT(floor) FILTER (WHERE floor ~ '^[0-9]+$') AS floor_count,
+                   SUM(size) AS size_sum, COUNT(size) AS size_count,
+                   SUM(priceByArea) AS price_by_area_sum, COUNT(priceByArea) AS price_by_area_count
+            FROM house WHERE {{since}}
+            GROUP BY ALL
+        """,
+    },
+    # Small and without snapshots, refreshed in full
+    'income': {
+        'income_neighborhood': """
+            SELECT neighborhood, SUM(rdlpc_eur) AS rdlpc_sum, COUNT(rdlpc_eur) AS rdlpc_count
+            FROM income
+            GROUP BY ALL
+        """,
+    },
+}
+
+
+def refresh_table_kpis(con, table_name, months=None):
+    # months are the months touched by the load, their KPIs are computed again from all their rows.
+    # None, a table without months or KPIs that do not exist yet are computed in full
+    incremental = months is not None and table_name != 'income' and has_kpis(con, table_name)
+    month_filter = "IN (SELECT UNNEST(CAST(? AS DATE[])))"
+    since = f"{MONTH} {month_filter}" if incremental else "TRUE"
+    parameters = [months] if incremental else []
+    for kpi_table, query in KPI_AGGREGATES[table_name].items():
+        con.execute(f"CREATE TABLE IF NOT EXISTS {KPI_SCHEMA}.{kpi_table} AS {query.format(since='FALSE')}")
+        if incremental:
+            con.execute(f"DELETE FROM {KPI_SCHEMA}.{kpi_table} WHERE month {month_filter}", parameters)
+        else:
+            con.execute(f"DELETE FROM {KPI_SCHEMA}.{kpi_table}")
+        con.execute(f"INSERT INTO {KPI_SCHEMA}.{kpi_table} BY NAME {query.format(since=since)}", parameters)
+
+
+def refresh_kpis(con, months=None):
+    # Called by the exploitation load on its read-write connection, inside its transaction
+    con.execute(f"CREATE SCHEMA IF NOT EXISTS {KPI_SCHEMA};")
+    tables = [table[0] for table in con.execute("SELECT table_name FROM information_schema.tables WHERE table_catalog = current_database() AND table_schema = 'main';").fetchall()]
+    for table_name in KPI_AGGREGATES:
+        if table_name in tables:
+            refresh_table_kpis(con, table_name, months)
+
+
+def has_kpis(con, table_name):
+    tables = con.execute(f"SELECT table_name FROM information_schema.tables WHERE table_catalog = current_database() AND table_schema = '{KPI_SCHEMA}';").fetchall()
+    existing_tables = [table[0] for table in tables]
+    return all(kpi_table in existing_tables for kpi_table in KPI_AGGREGATES[table_name])
+
+
 def analyze_idealista_kpis(db_path):
     # Connect to the DuckDB database
-    con = duckdb.connect(db_path)
+    con = get_connection(db_path, read_only=True)
     print(f"Connected to DuckDB database at '{db_path}'.")
-    
-    # Check if the table exists
-    tables = con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
-    existing_tables = [table[0] for table in tables]
-    
+
+    # Check if the KPIs exist
     table_name = 'idealista'
-    if table_name not in existing_tables:
-        print(f"Error: Table '{table_name}' does not exist in the database.")
+    if not has_kpis(con, table_name):
+        print(f"Error: KPIs of table '{table_name}' do not exist in the database, run the exploitation load first.")
         con.close()
         return
-    
+
     print(f"Analyzing KPIs for table: '{table_name}'.")
-    
+
     # KPI 1: Average Property Price
     avg_price_query = f"""
-        SELECT ROUND(AVG(price), 2) AS average_price
-        FROM {table_name}
+        SELECT ROUND(SUM(price_sum) / SUM(price_count), 2) AS average_price
+        FROM {KPI_SCHEMA}.idealista_price
     """
     avg_price = con.execute(avg_price_query).fetchone()[0]
     print(f"Average Property Price: €{avg_price}")
-    
-    # KPI 2: Median Property Price
+
+    # KPI 2: Median Property Price, from the merged monthly sketches (within 1%)
     median_price_query = f"""
-        SELECT ROUND(MEDIAN(price), 2) AS median_price
-        FROM {table_name}
+        SELECT ROUND(q50, 2) AS median_price
+        FROM ({quantiles_query(None, [], [0.5], sketch_table=f'{KPI_SCHEMA}.idealista_price_sketch')})
     """
-    median_price = con.execute(median_price_query).fetchone()[0]
+    median_price = con.execute(median_price_query).fetchone()
+    median_price = median_price[0] if median_price else None
     print(f"Median Property Price: €{median_price}")
-    
+
     # KPI 3: Average Price by Neighborhood
     avg_price_neighborhood_query = f"""
-        SELECT neighborhood, ROUND(AVG(price), 2) AS average_price
-        FROM {table_name}
+        SELECT neighborhood, ROUND(SUM(price_sum) / SUM(price_count), 2) AS average_price
+        FROM {KPI_SCHEMA}.idealista_price
         GROUP BY neighborhood
         ORDER BY average_price DESC
     """
     avg_price_neighborhood = con.execute(avg_price_neighborhood_query).fetchdf()
     print("\nAverage Property Price by Neighborhood:")
     print(avg_price_neighborhood)
-    
+
     # KPI 4: Price Trends Over Time
     price_trend_query = f"""
-        SELECT date_trunc('month', timestamp) AS month, ROUND(AVG(price), 2) AS average_price
-        FROM {table_name}
+        SELECT CAST(month AS TIMESTAMP) AS month, ROUND(SUM(price_sum) / SUM(price_count), 2) AS average_price
+        FROM {KPI_SCHEMA}.idealista_price
         GROUP BY month
         ORDER BY month
     """
     price_trend = con.execute(price_trend_query).fetchdf()
     print("\nPrice Trends Over Time:")
     print(price_trend)
-    
+
     # Close the connection
     con.close()
     print("Analysis complete.")
+    return {'average_price': avg_price, 'median_price': median_price,
+            'average_price_by_neighborhood': avg_price_neighborhood, 'price_trend': price_trend}
 
 def analyze_house_kpis(db_path):
     # Connect to the DuckDB database
-    con = duckdb.connect(db_path)
+    con = get_connection(db_path, read_only=True)
     print(f"Connected to DuckDB database at '{db_path}'.")
-    
-    # Check if the table exists
-    tables = con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
-    existing_tables = [table[0] for table in tables]
-    
+
+    # Check if the KPIs exist
     table_name = 'house'
-    if table_name not in existing_tables:
-        print(f"Error: Table '{table_name}' does not exist in the database.")
+    if not has_kpis(con, table_name):
+        print(f"Error: KPIs of table '{table_name}' do not exist in the database, run the exploitation load first.")
         con.close()
         return
-    
+
     print(f"Analyzing KPIs for table: '{table_name}'.")
-    
-    # KPI 1: Average Floor (excluding non-numeric values)
-    avg_floor_query = f"""
-        SELECT ROUND(AVG(CAST(floor AS DOUBLE)), 2) AS average_floor
-        FROM {table_name}
-        WHERE floor ~ '^[0-9]+$'
+
+    # KPI 1: Average Floor (excluding non-numeric values), KPI 2: Average Size of Properties, KPI 3: Average Price per Area
+    house_kpis_query = f"""
+        SELECT ROUND(SUM(floor_sum) / SUM(floor_count), 2) AS average_floor,
+               ROUND(SUM(size_sum) / SUM(size_count), 2) AS average_size,
+               ROUND(SUM(price_by_area_sum) / SUM(price_by_area_count), 2) AS average_price_by_area
+        FROM {KPI_SCHEMA}.house_month
     """
-    avg_floor = con.execute(avg_floor_query).fetchone()[0]
+    house_kpis = con.execute(house_kpis_query).fetchdf()
+    avg_floor, avg_size, avg_price_by_area = house_kpis.iloc[0]
     print(f"Average Floor (numeric only): {avg_floor}")
-    
-    # KPI 2: Average Size of Properties
-    avg_size_query = f"""
-        SELECT ROUND(AVG(size), 2) AS average_size
-        FROM {table_name}
-    """
-    avg_size = con.execute(avg_size_query).fetchone()[0]
     print(f"Average Property Size: {avg_size} m²")
-
-     # KPI 3: Average Price per Area
-    avg_price_by_area_query = f"""
-        SELECT ROUND(AVG(priceByArea), 2) AS average_price_by_area
-        FROM {table_name}
-    """
-    avg_price_by_area = con.execute(avg_price_by_area_query).fetchone()[0]
     print(f"Average Price per Area: €{avg_price_by_area} per m²")
 
     # Close the connection
     con.close()
     print("Analysis complete.")
+    return house_kpis
 
 def analyze_income_kpis(db_path):
     # Connect to the DuckDB database
-    con = duckdb.connect(db_path)
+    con = get_connection(db_path, read_only=True)
     print(f"Connected to DuckDB database at '{db_path}'.")
-    
-    # Check if the table exists
-    tables = con.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';").fetchall()
-    existing_tables = [table[0] for table in tables]
-    
+
+    # Check if the KPIs exist
     table_name = 'income'
-    if table_name not in existing_tables:
-        print(f"Error: Table '{table_name}' does not exist in the database.")
+    if not has_kpis(con, table_name):
+        print(f"Error: KPIs of table '{table_name}' do not exist in the database, run the exploitation load first.")
         con.close()
         return
-    
+
     print(f"Analyzing KPIs for table: '{table_name}'.")
-    
+
     # KPI 1: Average RDLpc by Neighborhood
     avg_rdlpc_query = f"""
-        SELECT neighborhood, ROUND(AVG(rdlpc_eur), 3) AS average_rdlpc
-        FROM {table_name}
+        SELECT neighborhood, ROUND(SUM(rdlpc_sum) / SUM(rdlpc_count), 3) AS average_rdlpc
+        FROM {KPI_SCHEMA}.income_neighborhood
         GROUP BY neighborhood
         ORDER BY average_rdlpc DESC
     """
     avg_rdlpc = con.execute(avg_rdlpc_query).fetchdf()
     print("\nAverage RDLpc by Neighborhood:")
     print(avg_rdlpc)
-    
+
     # Close the connection
     con.close()
     print("Analysis complete.")
+    return avg_rdlpc
 
 
 def run():
-    analyze_house_kpis(EXPLOITATION_DB)
-    analyze_idealista_kpis(EXPLOITATION_DB)
-    analyze_income_kpis(EXPLOITATION_DB)
+    # The KPIs are read from the tables maintained by the exploitation load (script4)
+    return {
+        'house': analyze_house_kpis(EXPLOITATION_DB),
+        'idealista': analyze_idealista_kpis(EXPLOITATION_DB),
+        'income': analyze_income_kpis(EXPLOITATION_DB),
+    }
 
 if __name__ == "__main__":
     run()
-
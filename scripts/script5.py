@@ -1,54 +1,57 @@
 import duckdb
-import math
 import os
-from difflib import SequenceMatcher
+
+from scripts.publishing import staged_database
+from scripts.connections import get_config
+from scripts.neighborhood_index import update_neighborhood_map
+from scripts.neighborhood_boundaries import update_point_map
+from scripts.geo_features import load_points_of_interest, get_feature_columns, compute_geo_features
 
 SOURCE_DB = './exploitation_zone/exploitation.db'
 DESTINATION_FOLDER = './model_zone/'
 
 DESTINATION_DB = os.path.join(DESTINATION_FOLDER, 'model.db')
 
+# How houses are linked to income: 'name' resolves their neighborhood names,
+# 'coordinates' places them in the neighborhood polygons and falls back to names outside of them
+NEIGHBORHOOD_ASSIGNMENT = 'name'
+
 os.makedirs("model_zone", exist_ok=True)
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate the Haversine distance between two geographic points."""
-    R = 6371  # Radius of the Earth in kilometers
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def find_closest_match(name, candidates):
-    """Find the closest matching name from a list of candidates."""
-    return max(candidates, key=lambda x: SequenceMatcher(None, name, x).ratio())
-
-def create_analytical_sandbox(source_db_path, target_db_path):
-    # Connect to the source and target DuckDB databases
-    source_conn = duckdb.connect(source_db_path)
-    target_conn = duckdb.connect(target_db_path)
-
-    # Fetch unique neighborhoods from the income table
-    income_neighborhoods = source_conn.execute("SELECT DISTINCT LOWER(neighborhood) AS neighborhood FROM income").fetchdf()['neighborhood'].tolist()
-
-    # Update house table with closest neighborhood match
-    house_data = source_conn.execute("SELECT DISTINCT LOWER(neighborhood) AS neighborhood FROM house WHERE neighborhood IS NOT NULL").fetchdf()
-    house_data['closest_match'] = house_data['neighborhood'].apply(lambda x: find_closest_match(x, income_neighborhoods))
-
-    # Update the house table with the matched neighborhoods
-    # for _, row in house_data.iterrows():
-    #     source_conn.execute(
-    #     """
-    #     UPDATE house
-    #     SET neighborhood = ?
-    #     WHERE LOWER(neighborhood) = ?;
-    #     """,
-    #     (row['closest_match'], row['neighborhood'])
-    #     )
-
-    # Query the source database to create the analytical sandbox data
-    query = """
+def create_analytical_sandbox(source_db_path, target_db_path, assignment=NEIGHBORHOOD_ASSIGNMENT):
+    # The sandbox is built inside the model database, the exploitation zone is attached read only
+    target_conn = duckdb.connect(target_db_path, config=get_config())
+    target_conn.execute(f"ATTACH '{source_db_path}' AS exploitation (READ_ONLY)")
+
+    # Neighborhood names of both tables are resolved to canonical ids, names resolved in earlier runs are looked up
+    names = target_conn.execute("""
+    SELECT DISTINCT LOWER(neighborhood) FROM exploitation.house WHERE neighborhood IS NOT NULL
+    UNION
+    SELECT DISTINCT LOWER(neighborhood) FROM exploitation.income WHERE neighborhood IS NOT NULL
+    """).fetchall()
+    update_neighborhood_map(target_conn, [name[0] for name in names])
+
+    # Coordinates assigned in earlier runs are looked up, only new points go through the polygons
+    by_coordinates = False
+    if assignment == 'coordinates':
+        points = target_conn.execute("SELECT DISTINCT latitude, longitude FROM exploitation.house").fetchdf()
+        by_coordinates = update_point_map(target_conn, points)
+    if by_coordinates:
+        point_join = "LEFT JOIN point_neighborhood pm ON pm.latitude = h.latitude AND pm.longitude = h.longitude"
+        house_neighborhood_id = "COALESCE(pm.neighborhood_id, hm.neighborhood_id)"
+    else:
+        point_join = ""
+        house_neighborhood_id = "hm.neighborhood_id"
+
+    # Geo features are computed once per distinct location, all of them in one vectorized pass
+    pois = load_points_of_interest()
+    feature_columns = get_feature_columns(pois)
+    points = target_conn.execute("SELECT DISTINCT latitude, longitude FROM exploitation.house WHERE latitude IS NOT NULL AND longitude IS NOT NULL").fetchdf()
+    target_conn.register('geo_features', compute_geo_features(points, pois))
+    feature_list = ',\n        '.join(f"g.{name}" for name, _ in feature_columns)
+
+    # Query the exploitation zone to create the analytical sandbox data
+    query = f"""
     SELECT 
         h.propertyCode, 
         h.size, 
@@ -62,19 +65,26 @@ def create_analytical_sandbox(source_db_path, target_db_path):
         CAST(i.timestamp AS DATE) AS date,
         CAST(SUBSTRING(CAST(i.timestamp AS VARCHAR), 6, 2) AS INT) AS month,  -- Extract month from timestamp
         CAST(SUBSTRING(CAST(i.timestamp AS VARCHAR), 1, 4) AS INT) AS year,   -- Extract year from timestamp
-        6371 * 2 * ASIN(SQRT(POWER(SIN((h.latitude - 41.38879) * PI() / 180 / 2), 2) + COS(h.latitude * PI() / 180) * COS(41.38879 * PI() / 180) * POWER(SIN((h.longitude - 2.15899) * PI() / 180 / 2), 2))) AS distance_to_center
-    FROM house h
-    INNER JOIN idealista i 
+        {feature_list}
+    FROM exploitation.house h
+    INNER JOIN exploitation.idealista i 
         ON h.propertyCode = i.propertyCode AND h.timestamp = i.timestamp
-    LEFT JOIN income n 
-        ON LOWER(h.neighborhood) = LOWER(n.neighborhood);
+    LEFT JOIN geo_features g
+        ON g.latitude = h.latitude AND g.longitude = h.longitude
+    LEFT JOIN neighborhood_map hm
+        ON hm.name = LOWER(h.neighborhood)
+    {point_join}
+    LEFT JOIN (
+        SELECT income.*, m.neighborhood_id
+        FROM exploitation.income income
+        JOIN neighborhood_map m ON m.name = LOWER(income.neighborhood)
+    ) n
+        ON n.neighborhood_id = {house_neighborhood_id};
     """
 
-    # Fetch the analytical sandbox data from the source database
-    sandbox_data = source_conn.execute(query).fetchall()
-
     # Define the schema for the target database
-    target_conn.execute("""
+    feature_definitions = ''.join(f",\n        {name} {data_type}" for name, data_type in feature_columns)
+    target_conn.execute(f"""
     CREATE OR REPLACE TABLE analytical_sandbox (
         propertyCode VARCHAR,
         size DOUBLE,
@@ -87,28 +97,24 @@ def create_analytical_sandbox(source_db_path, target_db_path):
         income_level DOUBLE,
         date DATE,
         month INT,
-        year INT,
-        distance_to_center DOUBLE
+        year INT{feature_definitions}
     );
     """)
 
-    # Insert the data into the target database
-    target_conn.executemany("""
-    INSERT INTO analytical_sandbox (
-        propertyCode, size, rooms, bathrooms, latitude, longitude, neighborhood,
-        price, income_level, date, month, year, distance_to_center
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-    """, sandbox_data)
+    # Insert the data into the target database, rows go from one database to the other inside DuckDB
+    target_conn.execute(f"INSERT INTO analytical_sandbox {query}")
 
     # Print success message
     print("Analytical sandbox table created successfully in the target database.")
 
     # Disconnect from the databases
-    source_conn.close()
+    target_conn.unregister('geo_features')
+    target_conn.execute("DETACH exploitation")
     target_conn.close()
 
 def run():
-    create_analytical_sandbox(SOURCE_DB, DESTINATION_DB)
+    with staged_database(DESTINATION_DB) as staging:
+        create_analytical_sandbox(SOURCE_DB, staging)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -1,9 +1,14 @@
-import duckdb
 import pandas as pd
 from sklearn.linear_model import LassoCV
 from sklearn.feature_selection import SelectFromModel
 from sklearn.impute import SimpleImputer
 
+from scripts.connections import get_connection
+from scripts.parquet_mirror import connect_mirror, is_current
+
+# The sandbox is read from the parquet mirror (script 6) when it is current, the model database is not opened
+READ_FROM_MIRROR = True
+
 def summarize_data(data):
     """Generate a summary of the dataset, including NaN counts."""
     summary = data.isna().sum().to_frame(name='NaN Count')
@@ -12,15 +17,20 @@ def summarize_data(data):
 
 # Function to perform feature selection
 def feature_selection(database_path, target_table):
-    # Connect to the DuckDB database
-    conn = duckdb.connect(database_path)
+    # Connect to the parquet mirror, or to the DuckDB database when the mirror is missing or older than it
+    if READ_FROM_MIRROR and is_current('model', target_table):
+        conn = connect_mirror(['model'])
+        source_table = f"model.{target_table}"
+    else:
+        conn = get_connection(database_path, read_only=True)
+        source_table = target_table
 
     # Query the data from the analytical sandbox table
     query = f"""
     SELECT 
         size, rooms, bathrooms, latitude, longitude, income_level, 
         month, year, distance_to_center, price
-        FROM {target_table};
+        FROM {source_table};
     """
     data = conn.execute(query).fetchdf()
 
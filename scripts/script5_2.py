@@ -1,4 +1,3 @@
-import duckdb
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.linear_model import LinearRegression
@@ -7,7 +6,8 @@ from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from script5_1 import feature_selection
+from scripts.script5_1 import feature_selection
+from scripts.connections import get_connection
 
 
 # Ensure model_zone directory exists
@@ -16,7 +16,7 @@ os.makedirs("plots/model_interpretation", exist_ok=True)
 
 # Fetch Data from DuckDB
 def fetch_data(database_path, table_name, columns, target):
-    conn = duckdb.connect(database_path)
+    conn = get_connection(database_path, read_only=True)
     column_str = ", ".join(columns + [target])
     query = f"SELECT {column_str} FROM {table_name} WHERE {target} IS NOT NULL;"
     data = conn.execute(query).fetchdf()
@@ -111,7 +111,7 @@ def main():
     rf_selected, y_pred_rf_selected = train_and_evaluate(X_train_s, X_test_s, y_train_s, y_test_s, use_feature_selection=True, suffix="selected")
 
     # Fetch all columns dynamically from DuckDB
-    conn = duckdb.connect(database_path)
+    conn = get_connection(database_path, read_only=True)
     all_columns = conn.execute(f"PRAGMA table_info({table_name});").fetchdf()["name"].tolist()
     conn.close()
     predictors = [col for col in all_columns if col != target]
@@ -0,0 +1,80 @@
+import duckdb
+
+from scripts import script3, script4
+from scripts.connections import close_all
+
+
+def create_formatted_zone(tmp_path, monkeypatch):
+    # The stages read and write the zones relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'formatted_zone').mkdir()
+    con = duckdb.connect(script3.SOURCE_DB)
+    con.execute("""
+    CREATE TABLE income_2020 AS
+    SELECT 'Eixample' AS Distric, 'la Dreta de l''Eixample' AS Barris, 30000 AS "RDLpc (€)", '2020' AS timestamp
+    """)
+    con.close()
+
+
+def add_snapshot(snapshot_date, listings):
+    # A per snapshot idealista table of the formatted zone, listings are (propertyCode, price)
+    day, month, year = snapshot_date.split('-')[::-1]
+    con = duckdb.connect(script3.SOURCE_DB)
+    con.execute(f"""
+    CREATE TABLE idealista_{day}_{month}_{year} AS
+    SELECT propertyCode, price, 'flat' AS propertyType, 'sale' AS operation, 80.0 AS size, 3 AS rooms, 2 AS bathrooms,
+           '1' AS floor, 'good' AS status, TRUE AS exterior, FALSE AS hasLift, FALSE AS newDevelopment,
+           41.39 AS latitude, 2.16 AS longitude, 'street' AS address, 'barcelona' AS province, 'barcelona' AS municipality,
+           'eixample' AS district, 'es' AS country, 'la dreta de l''eixample' AS neighborhood, price / 80 AS priceByArea,
+           '{snapshot_date}' AS timestamp
+    FROM (VALUES {', '.join(f"('{code}', {price})" for code, price in listings)}) AS listings(propertyCode, price)
+    """)
+    con.close()
+
+
+def run_pipeline():
+    script3.run()
+    result = script4.run()
+    close_all()
+    return result
+
+
+def count_rows(table_name, snapshot_date):
+    con = duckdb.connect(script4.DESTINATION_DB, read_only=True)
+    count = con.execute(f"SELECT COUNT(*) FROM {table_name} WHERE timestamp = CAST(? AS TIMESTAMP)", [snapshot_date]).fetchone()[0]
+    con.close()
+    return count
+
+
+def test_backfilled_snapshot_reaches_exploitation(tmp_path, monkeypatch):
+    create_formatted_zone(tmp_path, monkeypatch)
+    add_snapshot('2020-07-01', [('1', 300000), ('2', 350000)])
+    add_snapshot('2020-08-01', [('1', 310000), ('3', 400000)])
+    assert run_pipeline() == "Exploitation tables rebuilt"
+
+    # A snapshot older than the latest loaded one arrives late
+    add_snapshot('2020-06-01', [('4', 250000), ('5', 280000), ('6', 290000)])
+    assert run_pipeline() == "Exploitation tables updated from 2020-06-01 00:00:00"
+
+    assert count_rows('idealista', '2020-06-01') == 3
+    assert count_rows('house', '2020-06-01') == 3
+    assert count_rows('idealista', '2020-08-01') == 2
+
+
+def test_backfilled_month_kpis_are_computed(tmp_path, monkeypatch):
+    create_formatted_zone(tmp_path, monkeypatch)
+    add_snapshot('2020-07-01', [('1', 300000), ('2', 350000)])
+    add_snapshot('2020-08-01', [('1', 310000), ('3', 400000)])
+    run_pipeline()
+
+    # A second snapshot of a month already loaded and a month before the loaded ones
+    add_snapshot('2020-07-15', [('7', 320000)])
+    add_snapshot('2020-06-01', [('4', 250000), ('5', 280000)])
+    run_pipeline()
+
+    con = duckdb.connect(script4.DESTINATION_DB, read_only=True)
+    counts = dict(con.execute("SELECT month, SUM(price_count) FROM kpi.idealista_price GROUP BY month").fetchall())
+    expected = dict(con.execute("SELECT CAST(date_trunc('month', timestamp) AS DATE), COUNT(price) FROM idealista GROUP BY ALL").fetchall())
+    con.close()
+    assert counts == expected
+    assert sum(counts.values()) == 7